@@ -67,8 +67,9 @@ const createGame = async (userId) => {
     return response.json();
 };
 
-const getGames = async (userId) => {
-    const response = await fetch(`${API_BASE}/games`, {
+const getGames = async (userId, archiveOffset = 0, archiveLimit = 10) => {
+    const params = new URLSearchParams({ archive_offset: archiveOffset, archive_limit: archiveLimit });
+    const response = await fetch(`${API_BASE}/games?${params}`, {
         method: 'GET',
         headers: {
             'Content-Type': 'application/json',
@@ -117,6 +118,18 @@ const addMove = async (gameId, userId, word) => {
     return response.json();
 };
 
+const completeWord = async (prefix, limit = 10) => {
+    const params = new URLSearchParams({ prefix, limit });
+    const response = await fetch(`${API_BASE}/words/complete?${params}`, {
+        method: 'GET',
+        headers: {
+            'Content-Type': 'application/json',
+        },
+    });
+
+    return response.json();
+};
+
 module.exports = {
     createUser,
     getUser,
@@ -126,4 +139,5 @@ module.exports = {
     getGame,
     joinGame,
     addMove,
+    completeWord,
 };
\ No newline at end of file
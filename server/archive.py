@@ -0,0 +1,172 @@
+'''
+Moves old finished games out of the hot games collection.
+
+A finished game that hasn't changed for ARCHIVE_AFTER_DAYS (and has no scoring pending)
+is copied to games_archive as a small summary (players, key phrase, dates, rounds, final
+word) plus the full doc as zlib-compressed BSON, then deleted from games. get_games lists
+active games from the hot collection and pages through archive summaries, and get_game
+falls back to the archive, so archived games can still be opened.
+
+Run it next to the server, once or as a loop:
+
+    python archive.py [--days 30] [--batch-size 500]
+    python archive.py --loop --interval 3600
+
+rescore.py only re-scores games in the hot collection. stats.py's backfill reads both.
+'''
+import os
+import time
+import zlib
+import argparse
+from datetime import datetime, timedelta
+
+import bson
+from pymongo import DESCENDING
+
+# Local imports
+from mongoInterface import db
+import cache
+
+ARCHIVE_AFTER_DAYS = float(os.getenv('ARCHIVE_AFTER_DAYS', 30))
+
+# Fields of an archive doc other than the compressed game
+SUMMARY_FIELDS = ['key_phrase', 'player1', 'player2', 'created_at', 'finished_at', 'rounds', 'final_word']
+
+
+def summarize(game):
+    '''
+    The archive doc for a finished game
+    '''
+    return {
+        '_id': game['_id'],
+        'key_phrase': game.get('key_phrase'),
+        'player1': game['player1'],
+        'player2': game['player2'],
+        'created_at': game.get('created_at'),
+        'finished_at': game.get('updated_at'),
+        'rounds': len(game['player1_moves']),
+        'final_word': game['player1_moves'][-1] if game['player1_moves'] else None,
+        'game': bson.Binary(zlib.compress(bson.encode(game))),
+    }
+
+
+def expand(archived):
+    '''
+    The full game doc from an archive doc
+    '''
+    return bson.decode(zlib.decompress(archived['game']))
+
+
+def get_game(_id):
+    '''
+    An archived game doc by its ObjectId, or None
+    '''
+    archived = db.games_archive.find_one({'_id': _id}, {'game': 1})
+    return expand(archived) if archived else None
+
+
+def get_summaries(user_id, offset=0, limit=10):
+    '''
+    A page of a user's archived games, most recently finished first, from their
+    player's point of view (`opponent` is the other player's name)
+
+    Returns:
+        list: The summaries
+        bool: Whether there are more after this page
+    '''
+    rows, has_more = _page(user_id, offset, limit, SUMMARY_FIELDS)
+
+    users_by_id = cache.get_users(get_opponents(user_id, rows=rows))
+
+    summaries = []
+    for row in rows:
+        opponent = users_by_id.get(row['player2'] if row['player1'] == user_id else row['player1'])
+        summaries.append({
+            '_id': row['_id'],
+            'key_phrase': row['key_phrase'],
+            'created_at': row['created_at'],
+            'finished_at': row['finished_at'],
+            'rounds': row['rounds'],
+            'final_word': row['final_word'],
+            'opponent': opponent['name'] if opponent else None,
+        })
+
+    return summaries, has_more
+
+
+def get_opponents(user_id, offset=0, limit=10, rows=None):
+    '''
+    Provider ids of the opponents on a page of a user's archived games
+    (from the page's rows if given, otherwise read with just the players)
+    '''
+    if rows is None:
+        rows, _ = _page(user_id, offset, limit, ['player1', 'player2', 'finished_at'])
+
+    opponents = {row['player2'] if row['player1'] == user_id else row['player1'] for row in rows}
+    return opponents - {None}
+
+
+def _page(user_id, offset, limit, fields):
+    projection = {field: 1 for field in fields}
+    pages = [
+        db.games_archive.find({player: user_id}, projection).sort('finished_at', DESCENDING).limit(offset + limit + 1)
+        for player in ('player1', 'player2')
+    ]
+    # Merge the two index-ordered lists (a user is never both players)
+    rows = sorted([row for page in pages for row in page], key=lambda row: row['finished_at'] or datetime.min, reverse=True)
+    has_more = len(rows) > offset + limit
+    return rows[offset:offset + limit], has_more
+
+
+def archive_batch(cutoff, batch_size):
+    '''
+    Archive up to batch_size finished games last updated before cutoff
+
+    Returns:
+        int: The number of games found
+        int: The number archived (a game that changed since it was read is left for the next run)
+    '''
+    games = list(db.games.find(
+        {'game_state': 'finished', 'updated_at': {'$lt': cutoff}, 'score_pending': {'$ne': True}},
+    ).limit(batch_size))
+
+    archived = 0
+    for game in games:
+        # Copy first so a crash in between leaves the game in both places rather than neither
+        db.games_archive.replace_one({'_id': game['_id']}, summarize(game), upsert=True)
+        result = db.games.delete_one({'_id': game['_id'], 'version': game.get('version')})
+        archived += result.deleted_count
+        cache.games.pop(game['_id'])
+
+    return len(games), archived
+
+
+def run(days=ARCHIVE_AFTER_DAYS, batch_size=500, pause=1.0):
+    cutoff = datetime.now() - timedelta(days=days)
+    total = 0
+    while True:
+        found, archived = archive_batch(cutoff, batch_size)
+        total += archived
+        if found:
+            print(f'Archived {total:,} games')
+        if found < batch_size or not archived:
+            break
+        time.sleep(pause)
+
+    return total
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--days', type=float, default=ARCHIVE_AFTER_DAYS, help='Archive games finished this long ago (default: %(default)s)')
+    parser.add_argument('--batch-size', type=int, default=500, help='Games per batch (default: %(default)s)')
+    parser.add_argument('--pause', type=float, default=1.0, help='Seconds between batches (default: %(default)s)')
+    parser.add_argument('--loop', action='store_true', help='Keep running, archiving every --interval seconds')
+    parser.add_argument('--interval', type=float, default=3600, help='Seconds between runs with --loop (default: %(default)s)')
+    args = parser.parse_args()
+
+    while True:
+        run(args.days, args.batch_size, args.pause)
+        if not args.loop:
+            break
+        time.sleep(args.interval)
@@ -0,0 +1,155 @@
+'''
+Score a large file of word pairs offline.
+
+Streams pairs from CSV (first two columns, optional word1,word2 header) or JSONL
+({"word1": ..., "word2": ...} or ["a", "b"] per line) and writes one result per pair, in
+input order, as JSONL or CSV: word1, word2, score, optimal, and error for unknown words.
+
+Pairs are scored in chunks with ling.score_pairs (matrix-matrix products) across a pool
+of forked worker processes, which share the memory-mapped embedding cache. Only a few
+chunks per worker are in flight at a time, so memory stays flat for any input size.
+
+Usage:
+    python batch_score.py pairs.csv -o scores.jsonl [--workers 8] [--chunk-size 512]
+
+Run from the server directory (next to the GloVe file).
+'''
+import os
+
+# One BLAS thread per worker process, the pool provides the parallelism
+for var in ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']:
+    os.environ.setdefault(var, '1')
+
+import sys
+import csv
+import json
+import time
+import argparse
+import itertools
+import multiprocessing
+from collections import deque
+
+# Local imports
+import ling
+
+
+def read_pairs(path, fmt):
+    '''
+    Yield (word1, word2) from a CSV or JSONL file, or stdin for '-'
+    '''
+    f = sys.stdin if path == '-' else open(path, encoding='utf-8', newline='')
+    try:
+        if fmt == 'csv':
+            for i, row in enumerate(csv.reader(f)):
+                if i == 0 and [cell.strip().lower() for cell in row[:2]] == ['word1', 'word2']:
+                    continue
+                if len(row) >= 2:
+                    yield row[0], row[1]
+        else:
+            for line in f:
+                if not line.strip():
+                    continue
+                item = json.loads(line)
+                yield (item['word1'], item['word2']) if isinstance(item, dict) else (item[0], item[1])
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while chunk := list(itertools.islice(iterator, size)):
+        yield chunk
+
+
+def score_chunk(pairs):
+    '''
+    Score a chunk of pairs (runs in a worker)
+
+    Returns:
+        list: (word1, word2, score, optimal, error) per pair
+    '''
+    pairs = [(a.strip().lower(), b.strip().lower()) for a, b in pairs]
+    valid = [i for i, (a, b) in enumerate(pairs) if a in ling.word_index and b in ling.word_index]
+
+    results = [(a, b, None, None, 'unknown word') for a, b in pairs]
+    if valid:
+        rows1 = [ling.word_index[pairs[i][0]] for i in valid]
+        rows2 = [ling.word_index[pairs[i][1]] for i in valid]
+        scores, top = ling.score_pairs(rows1, rows2)
+        for i, score, row in zip(valid, scores, top[:, 0]):
+            optimal = ling.words[row] if row >= 0 else None
+            results[i] = (*pairs[i], round(float(score), 6), optimal, None)
+
+    return results
+
+
+def write_results(out, fmt, results):
+    if fmt == 'csv':
+        writer = csv.writer(out)
+        writer.writerows((a, b, '' if s is None else s, o or '', e or '') for a, b, s, o, e in results)
+    else:
+        for a, b, score, optimal, error in results:
+            out.write(json.dumps({'word1': a, 'word2': b, 'score': score, 'optimal': optimal, 'error': error}) + '\n')
+
+
+def run(chunks, workers, max_in_flight):
+    '''
+    Yield each chunk's results in input order, with at most max_in_flight chunks queued
+    '''
+    if workers <= 1:
+        yield from map(score_chunk, chunks)
+        return
+
+    # Fork after ling.load() so workers share the mapped matrix and vocabulary
+    with multiprocessing.get_context('fork').Pool(workers) as pool:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.apply_async(score_chunk, (chunk,)))
+            if len(pending) >= max_in_flight:
+                yield pending.popleft().get()
+
+        while pending:
+            yield pending.popleft().get()
+
+
+def _format(path, given):
+    if given:
+        return given
+    return 'csv' if path.lower().endswith('.csv') else 'jsonl'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('input', help="CSV or JSONL file of word pairs ('-' for stdin)")
+    parser.add_argument('-o', '--output', default='-', help="Output file (default: stdout)")
+    parser.add_argument('--input-format', choices=['csv', 'jsonl'], help='Default: from the file extension')
+    parser.add_argument('--output-format', choices=['csv', 'jsonl'], help='Default: from the file extension')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Worker processes (default: %(default)s)')
+    parser.add_argument('--chunk-size', type=int, default=512, help='Pairs per chunk (default: %(default)s)')
+    args = parser.parse_args()
+
+    in_format = _format(args.input, args.input_format)
+    out_format = _format(args.output, args.output_format)
+
+    ling.load()
+
+    out = sys.stdout if args.output == '-' else open(args.output, 'w', encoding='utf-8', newline='')
+    if out_format == 'csv':
+        csv.writer(out).writerow(['word1', 'word2', 'score', 'optimal', 'error'])
+
+    start = time.perf_counter()
+    done = 0
+    try:
+        chunks = chunked(read_pairs(args.input, in_format), args.chunk_size)
+        for results in run(chunks, args.workers, max_in_flight=2 * args.workers):
+            write_results(out, out_format, results)
+            done += len(results)
+            if done // args.chunk_size % 100 == 0:
+                print(f'{done:,} pairs, {done / (time.perf_counter() - start):,.0f}/s', file=sys.stderr)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+    elapsed = time.perf_counter() - start
+    print(f'Scored {done:,} pairs in {elapsed:.1f}s ({done / max(elapsed, 1e-9):,.0f}/s)', file=sys.stderr)
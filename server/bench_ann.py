@@ -0,0 +1,56 @@
+'''
+Benchmark the IVF optimal_word search against the exact scan.
+Reports p50/p99 latency and top-1 agreement with exact search for each nprobe.
+
+Usage:
+    python ling.py build-index
+    python bench_ann.py [n_pairs] [nprobe ...]
+
+Run from the server directory (next to the GloVe file).
+'''
+import sys
+import time
+import random
+import numpy as np
+
+import ling
+
+
+def run(pairs, mode, nprobe=None):
+    ling.SEARCH_MODE = mode
+    if nprobe:
+        ling.NPROBE = nprobe
+
+    results = []
+    times = []
+    for a, b in pairs:
+        a_vec = ling.vector(a)
+        b_vec = ling.vector(b)
+        start = time.perf_counter()
+        results.append(ling.optimal_word(a, b, a_vec, b_vec))
+        times.append(time.perf_counter() - start)
+
+    return results, np.array(times) * 1000
+
+
+if __name__ == '__main__':
+    ling.load()
+    if ling.ivf is None:
+        sys.exit('No IVF index for the current cache, run `python ling.py build-index` first')
+
+    n_pairs = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    nprobes = [int(x) for x in sys.argv[2:]] or [1, 4, 8, 16, 32, 64]
+
+    rng = random.Random(0)
+    pairs = [tuple(rng.sample(ling.words, 2)) for _ in range(n_pairs)]
+
+    exact, exact_ms = run(pairs, 'exact')
+    print(f'Vocabulary: {len(ling.words):,} words, {len(ling.ivf["centroids"])} lists, {n_pairs} pairs')
+    print(f'{"mode":<12} {"p50 ms":>8} {"p99 ms":>8} {"top-1":>7}')
+    print(f'{"exact":<12} {np.percentile(exact_ms, 50):8.3f} {np.percentile(exact_ms, 99):8.3f} {1:7.3f}')
+
+    for nprobe in nprobes:
+        approx, approx_ms = run(pairs, 'ivf', nprobe)
+        agreement = np.mean([x == y for x, y in zip(exact, approx)])
+        label = f'ivf/{nprobe}'
+        print(f'{label:<12} {np.percentile(approx_ms, 50):8.3f} {np.percentile(approx_ms, 99):8.3f} {agreement:7.3f}')
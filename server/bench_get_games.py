@@ -0,0 +1,163 @@
+'''
+Benchmark games.get_games latency as a function of the number of games a user is in,
+comparing the batched player enrichment against the old per-game user lookups.
+
+Runs against mongomock with a simulated network round trip added to every Mongo call.
+
+Usage:
+    pip install mongomock
+    python bench_get_games.py [rtt_ms]
+
+Run from the server directory (next to the GloVe file).
+'''
+import os
+import sys
+import json
+import time
+from datetime import datetime
+
+os.environ.setdefault('MONGO_URI', 'mongodb://localhost:27017')
+
+import mongomock
+from bson import json_util
+
+from mongoInterface import db
+import games
+
+
+class SlowCollection:
+    '''
+    Wraps a collection so every call costs one simulated round trip
+    '''
+    def __init__(self, collection, rtt):
+        self._collection = collection
+        self._rtt = rtt
+        self.calls = 0
+
+    def __getattr__(self, name):
+        attr = getattr(self._collection, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            self.calls += 1
+            time.sleep(self._rtt)
+            return attr(*args, **kwargs)
+
+        return call
+
+
+class SlowClient:
+    '''
+    Stands in for pymongo.MongoClient, handing out SlowCollections
+    '''
+    def __init__(self, rtt):
+        self._client = mongomock.MongoClient()
+        self._rtt = rtt
+        self.collections = {}
+
+    def __getitem__(self, db_name):
+        return SlowDatabase(self, db_name)
+
+    def collection(self, db_name, name):
+        if name not in self.collections:
+            self.collections[name] = SlowCollection(self._client[db_name][name], self._rtt)
+        return self.collections[name]
+
+
+class SlowDatabase:
+    def __init__(self, client, name):
+        self._client = client
+        self._name = name
+
+    def __getitem__(self, name):
+        return self._client.collection(self._name, name)
+
+
+def legacy_safe_bson(bson_obj):
+    '''
+    The original utils.safe_bson
+    '''
+    return json.loads(json_util.dumps(bson_obj))
+
+
+def legacy_get_games(user_id):
+    '''
+    The original implementation: two user lookups per game, and a cache that never hits
+    because the dict.get default is evaluated eagerly
+    '''
+    user = db.users.find_one({'provider_id': user_id})
+    if not user:
+        return {'error': 'User not found'}, 404
+
+    found = db.games.find({'$or': [{'player1': user_id}, {'player2': user_id}]})
+    response = {
+        'user': user,
+        'games': [legacy_safe_bson(game) for game in found],
+    }
+
+    userCache = {}
+    for game in response['games']:
+        p1 = userCache.get(game['player1'], db.users.find_one({'provider_id': game['player1']}, {'_id': 0}))
+        p2 = userCache.get(game['player2'], db.users.find_one({'provider_id': game['player2']}, {'_id': 0}))
+        userCache[game['player1']] = p1
+        userCache[game['player2']] = p2
+        game['player1'] = legacy_safe_bson(p1)
+        game['player2'] = legacy_safe_bson(p2)
+        if user_id != game['player1']['provider_id']:
+            game['player1'], game['player2'] = game['player2'], game['player1']
+            game['player1_moves'], game['player2_moves'] = game['player2_moves'], game['player1_moves']
+
+    return legacy_safe_bson(response), 200
+
+
+def seed(n_games):
+    db.users.delete_many({})
+    db.games.delete_many({})
+
+    opponents = [f'opponent-{i}' for i in range(20)]
+    db.users.insert_many([
+        {'provider_id': pid, 'name': pid, 'email': f'{pid}@example.com', 'provider': 'google', 'details': {}}
+        for pid in ['me'] + opponents
+    ])
+    db.games.insert_many([
+        {
+            'key_phrase': f'phrase {i}',
+            'created_at': datetime.now(),
+            'player1': 'me' if i % 2 else opponents[i % len(opponents)],
+            'player2': opponents[i % len(opponents)] if i % 2 else 'me',
+            'player1_moves': ['apple', 'banana'],
+            'player2_moves': ['orange', 'banana'],
+            'optimal_moves': ['fruit', 'banana'],
+            'scores': [0.5, 1.0],
+            'game_state': 'finished',
+        }
+        for i in range(n_games)
+    ])
+
+
+def measure(fn, repeat=3):
+    calls = sum(c.calls for c in client.collections.values())
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn('me')
+    elapsed = (time.perf_counter() - start) / repeat * 1000
+    calls = (sum(c.calls for c in client.collections.values()) - calls) / repeat
+
+    return elapsed, calls
+
+
+if __name__ == '__main__':
+    rtt_ms = float(sys.argv[1]) if len(sys.argv) > 1 else 0.5
+
+    client = SlowClient(rtt_ms / 1000)
+    db._client = client
+    db._pid = os.getpid()
+
+    print(f'Simulated round trip: {rtt_ms} ms')
+    print(f'{"games":>6} {"before ms":>10} {"calls":>6} {"after ms":>10} {"calls":>6}')
+    for n_games in [1, 10, 50, 200, 500]:
+        seed(n_games)
+        before_ms, before_calls = measure(legacy_get_games)
+        after_ms, after_calls = measure(games.get_games)
+        print(f'{n_games:>6} {before_ms:10.1f} {before_calls:6.0f} {after_ms:10.1f} {after_calls:6.0f}')
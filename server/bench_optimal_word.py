@@ -0,0 +1,75 @@
+'''
+Benchmark ling.optimal_word against the original per-word loop.
+
+Usage:
+    python bench_optimal_word.py [n_pairs] [seed]
+
+Run from the server directory (next to the GloVe file).
+'''
+import sys
+import time
+import random
+import numpy as np
+
+import ling
+
+
+def legacy_optimal_word(a, b, a_vec, b_vec, wordset):
+    '''
+    The original implementation: a python loop over a dict of per-word arrays
+    '''
+    if a == b:
+        return a
+
+    middle = (a_vec + b_vec) / 2
+    closest = None
+    closest_dist = 0
+
+    for word, vec in wordset.items():
+        if word in [a, b]:
+            continue
+
+        dist = ling.cos(middle, vec)
+        if dist > closest_dist:
+            closest_dist = dist
+            closest = word
+
+    return closest
+
+
+def time_calls(fn, pairs):
+    results = []
+    times = []
+    for a, b in pairs:
+        a_vec = ling.vector(a)
+        b_vec = ling.vector(b)
+        start = time.perf_counter()
+        results.append(fn(a, b, a_vec, b_vec))
+        times.append(time.perf_counter() - start)
+
+    return results, np.array(times) * 1000
+
+
+if __name__ == '__main__':
+    ling.load()
+    n_pairs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    seed = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+
+    rng = random.Random(seed)
+    pairs = [tuple(rng.sample(ling.words, 2)) for _ in range(n_pairs)]
+
+    wordset = {word: np.array(ling.vector(word)) for word in ling.words}
+    legacy = lambda a, b, a_vec, b_vec: legacy_optimal_word(a, b, a_vec, b_vec, wordset)
+
+    before, before_ms = time_calls(legacy, pairs)
+    after, after_ms = time_calls(ling.optimal_word, pairs)
+
+    matches = sum(x == y for x, y in zip(before, after))
+    print(f'Vocabulary: {len(ling.words):,} words, {n_pairs} pairs')
+    print(f'before (dict loop): mean {before_ms.mean():9.2f} ms  max {before_ms.max():9.2f} ms')
+    print(f'after  (matrix):    mean {after_ms.mean():9.2f} ms  max {after_ms.max():9.2f} ms')
+    print(f'speedup: {before_ms.mean() / after_ms.mean():.1f}x')
+    print(f'matching results: {matches}/{n_pairs}')
+    for (a, b), x, y in zip(pairs, before, after):
+        if x != y:
+            print(f'  mismatch for ({a}, {b}): {x} vs {y}')
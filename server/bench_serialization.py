@@ -0,0 +1,110 @@
+'''
+Microbenchmark the JSON encoding of a realistic get_games payload:
+the old safe_bson dumps/loads round trips (per game, per user, then the whole response)
+followed by jsonify, against encoding the raw docs once with utils.BSONJSONProvider.
+
+Usage:
+    python bench_serialization.py [n_games] [repeat]
+'''
+import sys
+import json
+import time
+import random
+from datetime import datetime, timedelta
+
+import bson
+from bson import json_util
+from flask import Flask
+
+import utils
+
+
+def legacy_safe_bson(bson_obj):
+    '''
+    The original utils.safe_bson
+    '''
+    return json.loads(json_util.dumps(bson_obj))
+
+
+def make_payload(n_games):
+    rng = random.Random(0)
+    words = ['apple', 'banana', 'orange', 'fruit', 'river', 'stone', 'cloud', 'music', 'paper', 'light']
+
+    def user(pid):
+        return {
+            'provider_id': pid,
+            'provider': 'google',
+            'name': f'Player {pid}',
+            'email': f'{pid}@example.com',
+            'details': {'sub': pid, 'picture': f'https://example.com/{pid}.png', 'email_verified': True},
+        }
+
+    me = {'_id': bson.ObjectId(), **user('me')}
+    games = []
+    for i in range(n_games):
+        rounds = rng.randint(1, 8)
+        created = datetime(2024, 1, 1) + timedelta(minutes=i, microseconds=rng.randint(0, 999999))
+        games.append({
+            '_id': bson.ObjectId(),
+            'key_phrase': f'phrase {i}',
+            'created_at': created,
+            'created_by': 'me',
+            'updated_at': created + timedelta(minutes=5),
+            'updated_by': 'me',
+            'player1': user('me'),
+            'player2': user(f'opponent-{i % 20}'),
+            'player1_moves': [rng.choice(words) for _ in range(rounds)],
+            'player2_moves': [rng.choice(words) for _ in range(rounds)],
+            'optimal_moves': [rng.choice(words) for _ in range(rounds)],
+            'scores': [rng.random() for _ in range(rounds)],
+            'score_pending': False,
+            'game_state': 'finished',
+            'version': rounds * 3,
+        })
+
+    return {'user': me, 'games': games}
+
+
+def legacy_encode(app, payload):
+    response = {
+        'user': payload['user'],
+        'games': [legacy_safe_bson({**game, 'player1': None, 'player2': None}) for game in payload['games']],
+    }
+    for game, raw in zip(response['games'], payload['games']):
+        game['player1'] = legacy_safe_bson(raw['player1'])
+        game['player2'] = legacy_safe_bson(raw['player2'])
+
+    return app.json.dumps(legacy_safe_bson(response))
+
+
+def encode(app, payload):
+    return app.json.dumps(payload)
+
+
+def timeit(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+if __name__ == '__main__':
+    n_games = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    legacy_app = Flask('legacy')
+    app = Flask('bson')
+    app.json = utils.BSONJSONProvider(app)
+
+    payload = make_payload(n_games)
+    before = legacy_encode(legacy_app, payload)
+    after = encode(app, payload)
+    if before != after:
+        sys.exit('Encoded output differs from the old path')
+
+    before_ms = timeit(lambda: legacy_encode(legacy_app, payload), repeat)
+    after_ms = timeit(lambda: encode(app, payload), repeat)
+    print(f'get_games payload with {n_games} games ({len(after) / 1024:.0f} KiB), identical output')
+    print(f'before (safe_bson round trips + jsonify): {before_ms:8.2f} ms')
+    print(f'after  (BSONJSONProvider):                {after_ms:8.2f} ms')
+    print(f'speedup: {before_ms / after_ms:.1f}x')
@@ -0,0 +1,100 @@
+'''
+Build a curated word list for LING_VALID_VOCAB or LING_PLAYABLE_VOCAB.
+
+Starts from the GloVe tokens kept by ling.keep_word, in GloVe's frequency order, then
+applies a rank cap, an allowlist (e.g. a dictionary file), a denylist and a stopword filter.
+Word list files have one word per line; blank lines and # comments are skipped.
+
+Usage:
+    # Moves can be any dictionary word in the top 200k
+    python build_vocab.py --max-rank 200000 --allow /usr/share/dict/words -o valid.txt
+    # Optimal words come from the 50k most common of those, without stopwords
+    python build_vocab.py --max-rank 50000 --allow valid.txt --deny deny.txt --stopwords -o playable.txt
+
+    LING_VALID_VOCAB=valid.txt LING_PLAYABLE_VOCAB=playable.txt python ling.py
+
+Run from the server directory (next to the GloVe file).
+'''
+import os
+import argparse
+
+# Local imports
+import ling
+
+# Common English function words, which make poor answers
+STOPWORDS = {
+    'about', 'above', 'after', 'again', 'against', 'all', 'also', 'and', 'any', 'are', 'because',
+    'been', 'before', 'being', 'below', 'between', 'both', 'but', 'can', 'could', 'did', 'does',
+    'doing', 'down', 'during', 'each', 'few', 'for', 'from', 'further', 'had', 'has', 'have',
+    'having', 'her', 'here', 'hers', 'herself', 'him', 'himself', 'his', 'how', 'into', 'its',
+    'itself', 'just', 'may', 'might', 'more', 'most', 'must', 'myself', 'nor', 'not', 'now', 'off',
+    'once', 'only', 'other', 'ought', 'our', 'ours', 'ourselves', 'out', 'over', 'own', 'same',
+    'shall', 'she', 'should', 'some', 'such', 'than', 'that', 'the', 'their', 'theirs', 'them',
+    'themselves', 'then', 'there', 'these', 'they', 'this', 'those', 'through', 'too', 'under',
+    'until', 'upon', 'very', 'was', 'were', 'what', 'when', 'where', 'which', 'while', 'who',
+    'whom', 'whose', 'why', 'will', 'with', 'within', 'without', 'would', 'yet', 'you', 'your',
+    'yours', 'yourself', 'yourselves',
+}
+
+
+def glove_words(path):
+    '''
+    Tokens kept by ling.keep_word, in file (frequency) order
+    '''
+    with open(path, 'rb') as f:
+        for raw in f:
+            word = raw.split(b' ', 1)[0].decode('utf-8')
+            if ling.keep_word(word):
+                yield word
+
+
+def build(path, max_rank=None, allow=None, deny=None, stopwords=None):
+    '''
+    Returns:
+        list: The kept words in frequency order
+        dict: How many words each filter dropped
+    '''
+    kept = []
+    dropped = {'rank': 0, 'allow': 0, 'deny': 0, 'stopwords': 0}
+    for rank, word in enumerate(glove_words(path)):
+        if max_rank is not None and rank >= max_rank:
+            dropped['rank'] += 1
+        elif allow is not None and word not in allow:
+            dropped['allow'] += 1
+        elif deny and word in deny:
+            dropped['deny'] += 1
+        elif stopwords and word in stopwords:
+            dropped['stopwords'] += 1
+        else:
+            kept.append(word)
+
+    return kept, dropped
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-o', '--output', required=True, help='Word list file to write')
+    parser.add_argument('--glove', default=ling.FPATH, help='GloVe text file (default: %(default)s)')
+    parser.add_argument('--max-rank', type=int, help='Keep only the N most frequent words')
+    parser.add_argument('--allow', help='Keep only words in this word list (e.g. a dictionary)')
+    parser.add_argument('--deny', help='Drop words in this word list')
+    parser.add_argument('--stopwords', nargs='?', const='builtin', help='Drop stopwords (the built-in list, or a word list file)')
+    args = parser.parse_args()
+
+    allow = set(ling.read_word_list(args.allow)) if args.allow else None
+    deny = set(ling.read_word_list(args.deny)) if args.deny else None
+    stopwords = None
+    if args.stopwords:
+        stopwords = STOPWORDS if args.stopwords == 'builtin' else set(ling.read_word_list(args.stopwords))
+
+    kept, dropped = build(args.glove, args.max_rank, allow, deny, stopwords)
+
+    tmp = args.output + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(kept) + '\n')
+    os.replace(tmp, args.output)
+
+    print(f'Wrote {len(kept):,} words to {args.output}')
+    for name, count in dropped.items():
+        if count:
+            print(f'  dropped {count:,} by {name}')
@@ -0,0 +1,172 @@
+'''
+Write-through cache of game and user docs in front of mongoInterface.db.
+
+Hot games and their players are read over and over (polling, ETag checks, enrichment),
+so those docs are kept in memory. Every write in games.py, users.py and scoring.py
+puts its post-update doc here. Docs carry a `version` that every write increments, and a
+doc is only cached if it's at least as new as the cached one, so a read that raced with
+a write can't put back the older doc.
+
+The cache is per process, and other processes write too (other gunicorn workers, rescore.py).
+Their writes are picked up by events.py's watcher (the same poll or change stream that feeds the
+game event streams), which drops or replaces the cached docs they made stale. So a hit never
+touches Mongo, and a write elsewhere is seen here within GAME_EVENTS_POLL_INTERVAL (or as soon as
+the change stream delivers it). Entries also expire after GAME_CACHE_TTL seconds, which bounds
+anything the watcher misses (a game archived by another process under the poll source, a watcher
+outage, or GAME_EVENTS_SOURCE=local, which assumes a single process makes every write).
+Set GAME_CACHE_TTL=0 to turn the cache off.
+'''
+import os
+import copy
+import threading
+
+# Local imports
+from mongoInterface import db
+import utils
+import metrics
+
+TTL = float(os.getenv('GAME_CACHE_TTL', 30))
+MAX_GAMES = int(os.getenv('GAME_CACHE_GAMES', 4096))
+MAX_USERS = int(os.getenv('GAME_CACHE_USERS', 8192))
+
+# game _id -> game doc, provider_id -> user doc, key_phrase -> game _id
+games = utils.LRUCache(MAX_GAMES, TTL)
+users = utils.LRUCache(MAX_USERS, TTL)
+phrases = utils.LRUCache(MAX_GAMES, TTL)
+
+# Makes the version check and put one step
+_lock = threading.Lock()
+
+# Cached docs dropped because another process wrote a newer version
+invalidations = {'games': 0, 'users': 0}
+
+
+def get_game(_id):
+    '''
+    A game doc by its ObjectId, or None if it doesn't exist
+    '''
+    game = games.get(_id) if TTL > 0 else None
+    if game is not None:
+        return copy.deepcopy(game)
+
+    game = db.games.find_one({'_id': _id})
+    if game:
+        put_game(game)
+
+    return game
+
+
+def get_game_by_phrase(key_phrase):
+    '''
+    A game doc by its key phrase, or None if it doesn't exist
+    '''
+    _id = phrases.get(key_phrase) if TTL > 0 else None
+    if _id is not None:
+        return get_game(_id)
+
+    game = db.games.find_one({'key_phrase': key_phrase})
+    if game:
+        put_game(game)
+
+    return game
+
+
+def get_user(provider_id):
+    '''
+    A user doc by its provider id, or None if it doesn't exist
+    '''
+    return get_users([provider_id]).get(provider_id)
+
+
+def get_users(provider_ids):
+    '''
+    User docs for several provider ids, fetching the ones that aren't cached in one query
+
+    Returns:
+        dict: provider_id -> user doc, for the users that exist
+    '''
+    found = {}
+    missing = []
+    for provider_id in provider_ids:
+        user = users.get(provider_id) if TTL > 0 else None
+        if user is None:
+            missing.append(provider_id)
+        else:
+            found[provider_id] = copy.deepcopy(user)
+
+    if missing:
+        for user in db.users.find({'provider_id': {'$in': missing}}):
+            put_user(user)
+            found[user['provider_id']] = user
+
+    return found
+
+
+def put_game(game):
+    '''
+    Cache a full game doc, unless a newer version is already cached
+    '''
+    if TTL > 0 and _put(games, game['_id'], game) and game.get('key_phrase'):
+        phrases.put(game['key_phrase'], game['_id'])
+
+
+def put_user(user):
+    '''
+    Cache a full user doc, unless a newer version is already cached
+    '''
+    if TTL > 0:
+        _put(users, user['provider_id'], user)
+
+
+def invalidate_game(_id, version):
+    '''
+    Drop a cached game if it's older than a version written elsewhere
+    '''
+    _invalidate(games, 'games', _id, version)
+
+
+def invalidate_user(provider_id, version):
+    '''
+    Drop a cached user if it's older than a version written elsewhere
+    '''
+    _invalidate(users, 'users', provider_id, version)
+
+
+def is_empty():
+    return not len(games) and not len(users)
+
+
+def _invalidate(lru, name, key, version):
+    with _lock:
+        cached = lru.peek(key)
+        if cached is None or cached.get('version', 0) >= version:
+            return
+
+        lru.pop(key)
+        invalidations[name] += 1
+
+
+def _put(lru, key, doc):
+    with _lock:
+        cached = lru.peek(key)
+        if cached is not None and cached.get('version', 0) > doc.get('version', 0):
+            return False
+
+        lru.put(key, copy.deepcopy(doc))
+        return True
+
+
+def _collect():
+    caches = {'games': games, 'users': users, 'phrases': phrases}
+    return [
+        ('converge_cache_hits_total', 'counter', 'Game/user cache hits',
+            [({'cache': name}, lru.hits) for name, lru in caches.items()]),
+        ('converge_cache_misses_total', 'counter', 'Game/user cache misses',
+            [({'cache': name}, lru.misses) for name, lru in caches.items()]),
+        ('converge_cache_invalidations_total', 'counter', 'Cached docs dropped for a newer version written by another process',
+            [({'cache': name}, count) for name, count in invalidations.items()]),
+        ('converge_cache_entries', 'gauge', 'Game/user cache entries',
+            [({'cache': name}, len(lru)) for name, lru in caches.items()]),
+    ]
+
+metrics.collectors.append(_collect)
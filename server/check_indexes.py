@@ -0,0 +1,88 @@
+'''
+Runs explain() on every query shape used in games.py/users.py/stats.py/archive.py and fails if
+any of them falls back to a collection scan (COLLSCAN).
+
+Usage:
+    python check_indexes.py
+
+Needs a real MongoDB (MONGO_URI in server/.env), mongomock doesn't support explain().
+'''
+import sys
+import bson
+from datetime import datetime
+
+from mongoInterface import db
+import stats
+
+SAMPLE_USER = 'check-indexes-user'
+SAMPLE_ID = bson.ObjectId()
+
+# (collection, description, filter[, sort]) for each query shape
+QUERIES = [
+    ('users', 'user by provider_id', {'provider_id': SAMPLE_USER}),
+    ('users', 'players for enrich_games', {'provider_id': {'$in': [SAMPLE_USER, 'other']}}),
+    ('users', 'recent changes (events poll)', {'changed_at': {'$gte': datetime.now()}}),
+    ('games', 'game by id', {'_id': SAMPLE_ID}),
+    ('games', 'game by key_phrase', {'key_phrase': 'sample phrase'}),
+    ('games', 'games for a user', {'$or': [{'player1': SAMPLE_USER}, {'player2': SAMPLE_USER}]}),
+    ('games', 'add_move conditional update', {
+        '_id': SAMPLE_ID,
+        'game_state': 'in_progress',
+        '$or': [
+            {'player1': SAMPLE_USER, '$expr': {'$lte': [{'$size': '$player1_moves'}, {'$size': '$player2_moves'}]}},
+            {'player2': SAMPLE_USER, '$expr': {'$lte': [{'$size': '$player2_moves'}, {'$size': '$player1_moves'}]}},
+        ],
+    }),
+    ('games', 'scoring conditional update', {'_id': SAMPLE_ID, 'scores': {'$size': 0}}),
+    ('games', 'recent changes (events poll)', {'changed_at': {'$gte': datetime.now()}}),
+    ('games', 'archive candidates', {'game_state': 'finished', 'updated_at': {'$lt': datetime.now()}, 'score_pending': {'$ne': True}}),
+    ('games_archive', 'archived game by id', {'_id': SAMPLE_ID}),
+    ('games_archive', 'archive page (player1)', {'player1': SAMPLE_USER}, [('finished_at', -1)]),
+    ('games_archive', 'archive page (player2)', {'player2': SAMPLE_USER}, [('finished_at', -1)]),
+    ('user_stats', 'stats by provider_id', {'provider_id': SAMPLE_USER}),
+] + [
+    ('user_stats', f'{name} leaderboard', query, [(field, direction), ('provider_id', 1)])
+    for name, (field, direction, query) in stats.BOARDS.items()
+]
+
+
+def stages(plan):
+    '''
+    Every stage name in an explain plan
+    '''
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            yield plan['stage']
+        for value in plan.values():
+            yield from stages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            yield from stages(value)
+
+
+def check():
+    failures = []
+    for collection, description, query, *sort in QUERIES:
+        cursor = db.db[collection].find(query)
+        if sort:
+            cursor = cursor.sort(sort[0])
+        explain = cursor.explain()
+        plan = explain['queryPlanner']['winningPlan']
+        plan_stages = list(stages(plan))
+
+        status = 'FAIL' if 'COLLSCAN' in plan_stages else 'ok'
+        print(f'{status:<5} {collection}: {description} ({" > ".join(plan_stages)})')
+        if status == 'FAIL':
+            failures.append(description)
+
+    return failures
+
+
+if __name__ == '__main__':
+    db.ensure_indexes()
+    failures = check()
+    if failures:
+        print(f'{len(failures)} query shape(s) use a collection scan')
+        sys.exit(1)
+
+    print('All query shapes use an index')
@@ -0,0 +1,256 @@
+'''
+In-process pub/sub of game changes, streamed to clients by GET /games/<game_id>/events.
+
+Events are tagged with the game doc's `version` after the write, so an event id means the
+same thing in every process and across restarts. Each game has a channel with a short buffer
+of recent events, so a reconnecting client can resume from the last version it saw, as long as
+every change since then is buffered. Events carry the current value of the fields that changed
+(see EVENT_FIELDS), so applying one twice is harmless. The fields are stored as in the game doc;
+games.view_event turns them into each subscriber's point of view.
+
+games.py and scoring.py publish after each write, which reaches subscribers on the same process.
+GAME_EVENTS_SOURCE picks how writes made by other processes (other gunicorn workers, rescore.py)
+get here:
+    - poll (default): a thread per process reads the ids and versions of games and users changed
+      since its last poll (every write stamps `changed_at`) every GAME_EVENTS_POLL_INTERVAL
+      seconds, and fetches the games with subscribers here that are behind. Nothing is read
+      while no one is subscribed and nothing is cached.
+    - changestream: a Mongo change stream feeds every process (needs a replica set).
+    - local: no other processes, for a single process that makes every write.
+The same changes drop or replace the docs they made stale in this process's cache (cache.py).
+'''
+import os
+import threading
+import traceback
+from datetime import timedelta
+from collections import OrderedDict
+
+# Local imports
+from mongoInterface import db
+import cache
+import utils
+
+SOURCE = os.getenv('GAME_EVENTS_SOURCE', 'poll')
+POLL_INTERVAL = float(os.getenv('GAME_EVENTS_POLL_INTERVAL', 0.5))
+# How far back each poll looks before the newest change it has seen, for writes stamped
+# earlier but committed later
+POLL_OVERLAP = timedelta(seconds=2)
+BUFFER_SIZE = 64
+MAX_CHANNELS = 1000
+
+# Fields sent with each event type
+EVENT_FIELDS = {
+    'move': ['player1_moves', 'player2_moves', 'game_state', 'score_pending'],
+    'score': ['scores', 'optimal_moves', 'hints', 'score_pending'],
+    'state': ['player1', 'player2', 'game_state'],
+}
+
+
+class Channel:
+    def __init__(self):
+        # Latest game version published here
+        self.version = 0
+        # (version, previous version, event, data) in version order
+        self.events = []
+        self.cond = threading.Condition()
+
+    def publish(self, version, items, prev=None):
+        '''
+        Add the (event, data) items for one write, tagged with the game's version after it.
+        prev is the version they bring a subscriber up from: the one before by default, or
+        whatever this channel had when a poll finds several writes at once.
+        '''
+        with self.cond:
+            if prev is not None and version <= self.version:
+                # Already published here
+                return
+
+            # Writes can finish out of order, keep the buffer sorted by version
+            prev = version - 1 if prev is None else prev
+            at = len(self.events)
+            while at and self.events[at - 1][0] > version:
+                at -= 1
+            self.events[at:at] = [(version, prev, event, data) for event, data in items]
+            del self.events[:-BUFFER_SIZE]
+
+            self.version = max(self.version, version)
+            self.cond.notify_all()
+
+    def since(self, version):
+        '''
+        Events after a version, or None if some changes since then aren't buffered
+        (dropped from the buffer, made elsewhere and not picked up yet, or not published yet)
+        '''
+        with self.cond:
+            pending = [item for item in self.events if item[0] > version]
+
+            # Each write's events must follow on from the ones before
+            reached = version
+            for event_version, prev, _, _ in pending:
+                if event_version == reached:
+                    continue
+                if prev > reached:
+                    return None
+                reached = event_version
+            if reached != self.version:
+                return None
+
+            return [(event_version, event, data) for event_version, _, event, data in pending]
+
+    def wait(self, version, timeout):
+        '''
+        Block until there are events after a version (or the timeout passes)
+        '''
+        with self.cond:
+            self.cond.wait_for(lambda: self.version > version, timeout)
+
+        return self.since(version)
+
+
+_channels = OrderedDict()
+_lock = threading.Lock()
+_watcher_pid = None
+
+
+def channel(game_id):
+    '''
+    Get (or create) the channel for a game. Least recently used channels are dropped
+    past MAX_CHANNELS, their subscribers fall back to a fresh snapshot.
+    '''
+    game_id = str(game_id)
+    with _lock:
+        if game_id not in _channels:
+            _channels[game_id] = Channel()
+            while len(_channels) > MAX_CHANNELS:
+                _channels.popitem(last=False)
+        _channels.move_to_end(game_id)
+        found = _channels[game_id]
+
+    start()
+
+    return found
+
+
+def publish(game, event):
+    '''
+    Publish a change to a game from its post-update doc
+    '''
+    if SOURCE == 'changestream':
+        # The change stream publishes every write
+        return
+
+    _publish(game, [event])
+
+
+def _publish(game, events, version=None, prev=None):
+    items = [(event, _fields(game, event)) for event in events]
+    channel(game['_id']).publish(game.get('version', 0) if version is None else version, items, prev)
+
+
+def _fields(game, event):
+    return {key: game.get(key) for key in EVENT_FIELDS[event]}
+
+
+def start():
+    '''
+    Start the thread that picks up other processes' writes, once per process
+    (threads don't survive a fork)
+    '''
+    global _watcher_pid
+
+    if SOURCE == 'local':
+        return
+
+    with _lock:
+        if _watcher_pid == os.getpid():
+            return
+        _watcher_pid = os.getpid()
+
+    target = _watch if SOURCE == 'changestream' else _poll
+    threading.Thread(target=target, name='game-events', daemon=True).start()
+
+
+def _poll():
+    seen = utils.utcnow()
+    while True:
+        threading.Event().wait(POLL_INTERVAL)
+        try:
+            seen = poll_once(seen)
+        except Exception:
+            print('Polling for game changes failed:')
+            print(traceback.format_exc())
+
+
+def poll_once(seen):
+    '''
+    Drop cached docs changed since `seen` (less POLL_OVERLAP), and publish the changes
+    to subscribed games that this process hasn't published yet
+
+    Returns:
+        datetime: The newest change seen, to pass to the next poll
+    '''
+    with _lock:
+        subscribed = dict(_channels)
+    if not subscribed and cache.is_empty():
+        return utils.utcnow()
+
+    since = {'changed_at': {'$gte': seen - POLL_OVERLAP}}
+    changed = list(db.games.find(since, {'version': 1, 'changed_at': 1}))
+    changed_users = list(db.users.find(since, {'provider_id': 1, 'version': 1, 'changed_at': 1}))
+
+    behind = {}
+    for row in changed:
+        cache.invalidate_game(row['_id'], row.get('version', 0))
+        found = subscribed.get(str(row['_id']))
+        if found is not None and row.get('version', 0) > found.version:
+            behind[row['_id']] = found
+
+    for row in changed_users:
+        cache.invalidate_user(row['provider_id'], row.get('version', 0))
+
+    if behind:
+        for game in db.games.find({'_id': {'$in': list(behind)}}):
+            cache.put_game(game)
+            found = behind[game['_id']]
+            # One event per type with the latest fields, bringing subscribers up from what's published here
+            found.publish(game.get('version', 0), [(event, _fields(game, event)) for event in EVENT_FIELDS], found.version)
+
+    return max([seen] + [row['changed_at'] for row in changed + changed_users])
+
+
+def _watch():
+    pipeline = [{'$match': {
+        'ns.coll': {'$in': ['games', 'users']},
+        'operationType': {'$in': ['update', 'delete']},
+    }}]
+    while True:
+        try:
+            with db.db.watch(pipeline, full_document='updateLookup') as stream:
+                for change in stream:
+                    if change['operationType'] == 'delete':
+                        if change['ns']['coll'] == 'games':
+                            cache.games.pop(change['documentKey']['_id'])
+                        continue
+
+                    doc = change.get('fullDocument')
+                    if not doc:
+                        continue
+
+                    if change['ns']['coll'] == 'users':
+                        cache.invalidate_user(doc['provider_id'], doc.get('version', 0))
+                        continue
+
+                    game = doc
+                    cache.invalidate_game(game['_id'], game.get('version', 0))
+
+                    # One write can change fields of several event types, publish them together.
+                    # The looked up doc can be from a later write, so tag with the version this one set.
+                    updated = change['updateDescription']['updatedFields']
+                    changed = {key.split('.')[0] for key in updated}
+                    found = [event for event, fields in EVENT_FIELDS.items() if changed.intersection(fields)]
+                    if found:
+                        _publish(game, found, updated.get('version'))
+        except Exception:
+            print('Game change stream failed, restarting:')
+            print(traceback.format_exc())
+            threading.Event().wait(5)
@@ -1,5 +1,8 @@
 # Library imports
 import bson
+import hashlib
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
 from codename import codename
 from datetime import datetime
 
@@ -7,6 +10,14 @@ from datetime import datetime
 from mongoInterface import db
 import utils
 import ling
+import cache
+import stats
+import archive
+import scoring
+import events
+
+# Seconds add_move waits for the word model before answering 503
+LING_READY_TIMEOUT = 2
 
 def create_game(user_id):
     '''
@@ -19,13 +30,13 @@ def create_game(user_id):
         tuple: A tuple containing the game ID and a status code
     '''
     # Check the user exists
-    user = db.users.find_one({'provider_id': user_id})
+    user = cache.get_user(user_id)
     if not user:
         return {'error': 'User not found'}, 404
 
     # Construct the doc
     doc = {
-        'key_phrase': codename(),
+        'key_phrase': None,
         'created_at': datetime.now(),
         'created_by': user_id,
         'updated_at': datetime.now(),
@@ -35,12 +46,28 @@ def create_game(user_id):
         'player1_moves': [],
         'player2_moves': [],
         'optimal_moves': [],
+        'hints': [],
         'scores': [],
+        'score_models': [],
+        'score_pending': False,
         'game_state': 'pending',
+        'version': 0,
+        'changed_at': utils.utcnow(),
     }
 
-    # Insert doc to mongo
-    insert_result = db.games.insert_one(doc)
+    # Insert doc to mongo, picking a new key phrase if it's already taken
+    for _ in range(5):
+        doc['key_phrase'] = codename()
+        doc.pop('_id', None)
+        try:
+            insert_result = db.games.insert_one(doc)
+            break
+        except DuplicateKeyError:
+            continue
+    else:
+        return {'error': 'Failed to pick a unique key phrase'}, 500
+
+    cache.put_game(doc)
 
     return str(insert_result.inserted_id), 200
 
@@ -48,8 +75,6 @@ def join_game(game_phrase, user_id):
     '''
     Updates a game doc to include a new player
     '''
-    print('inside join_game:', game_phrase)
-
     if not user_id:
         return {'error': 'No user id provided'}, 400
 
@@ -60,12 +85,10 @@ def join_game(game_phrase, user_id):
     if code != 200:
         return game, code
 
-    print('found game:', game)
-
     # If game is full, return error
     if game['player2']:
         if user_id in [game['player1'], game['player2']]:
-            return utils.safe_bson(game), 200
+            return game, 200
         else:
             return {'error': 'Game is full'}, 403
 
@@ -73,105 +96,197 @@ def join_game(game_phrase, user_id):
     if user_id == game['player1']:
         return {'error': 'You cannot join your own game'}, 400
 
-    # Update game doc to include new player
-    print('game id:', game['_id'], type(game['_id']))
-    usableId = bson.ObjectId(game['_id']['$oid'])
-    print('usableId:', usableId, type(usableId))
-    print('user_id:', user_id, type(user_id))
+    # Update game doc to include new player (unless someone else joined since it was read)
     result = db.games.find_one_and_update(
-        {'_id': usableId},
+        {'_id': game['_id'], 'player2': None},
         {'$set': {
             'player2': user_id,
             'game_state': 'in_progress',
             'updated_at': datetime.now(),
             'updated_by': user_id,
-        }},
+            'changed_at': utils.utcnow(),
+        },
+        '$inc': {'version': 1}},
         return_document=True
     )
-    print('result:', result)
 
     # Check that the update was successful
     if not result:
-        return {'error': 'Failed to update game while joining'}, 500
+        return {'error': 'Game is full'}, 403
+
+    cache.put_game(result)
+    events.publish(result, 'state')
+    stats.record_join(result)
 
     # Return the updated game
-    return utils.safe_bson(result), 200
+    return result, 200
 
-def get_games(user_id):
+def get_games(user_id, archive_offset=0, archive_limit=10):
     '''
-    Gets IDs ofall games that a user is involved in (joined or created)
+    Gets all active games that a user is involved in (joined or created),
+    and a page of summaries of their archived games
     '''
     # Check user exists
-    user = db.users.find_one({'provider_id': user_id})
+    user = cache.get_user(user_id)
     if not user:
         return {'error': 'User not found'}, 404
 
     # Get all games that the user is involved in
-    games = db.games.find({
+    games = list(db.games.find({
         '$or': [
             {'player1': user_id},
             {'player2': user_id}
         ]
-    })
+    }))
+    for game in games:
+        cache.put_game(game)
+
+    # Skip games caught between being copied to the archive and deleted here
+    summaries, has_more = archive.get_summaries(user_id, archive_offset, archive_limit)
+    active_ids = {game['_id'] for game in games}
 
-    # TODO: Enrich with actual details
+    # Enrich game objects with user details
     response = {
         'user': user,
-        'games': [utils.safe_bson(game) for game in games],
+        'games': enrich_games(games, user_id),
+        'archived': {
+            'games': [summary for summary in summaries if summary['_id'] not in active_ids],
+            'offset': archive_offset,
+            'has_more': has_more,
+        },
     }
 
-    # Enrich game objects with user details
-    userCache = {}
-    for game in response['games']:
-        # Pull user data
-        p1 = userCache.get(game['player1'], db.users.find_one({'provider_id': game['player1']}, {'_id': 0}))
-        p2 = userCache.get(game['player2'], db.users.find_one({'provider_id': game['player2']}, {'_id': 0}))
+    return response, 200
 
-        # Save to cache for other games in list
-        userCache[game['player1']] = p1
-        userCache[game['player2']] = p2
+def get_game(game_id, user_id):
+    '''
+    Gets the full details for a game (active or archived)
+    '''
+    loaded, code = load_game(game_id, user_id)
+    if code != 200:
+        return loaded, code
+
+    return view_game(*loaded, user_id), 200
+
+def load_game(game_id, user_id):
+    '''
+    Loads a game (active or archived) and its players' user docs, for a player in it
 
-        # Enrich game with user details
-        game['player1'] = utils.safe_bson(p1)
-        game['player2'] = utils.safe_bson(p2)
+    Returns:
+        tuple: (game doc, provider_id -> user doc) and a status code
+    '''
+    game = cache.get_game(bson.ObjectId(game_id)) or archive.get_game(bson.ObjectId(game_id))
+    if not game:
+        return {'error': 'Game not found'}, 404
+
+    if user_id != game['player1'] and user_id != game['player2']:
+        return {'error': 'User not involved in game'}, 403
+
+    # Pick up rounds whose scoring job was lost (e.g. the worker restarted)
+    if game.get('score_pending'):
+        scoring.submit(game['_id'])
+
+    users_by_id = cache.get_users({game['player1'], game['player2']} - {None})
+
+    return (game, users_by_id), 200
+
+def view_game(game, users_by_id, user_id):
+    '''
+    A loaded game from a player's point of view (see enrich_games)
+    '''
+    return enrich_games([game], user_id, users_by_id)[0]
+
+def view_event(data, user_id, player1):
+    '''
+    A game event's data from a player's point of view, the same way view_game shows the game:
+    user docs instead of player ids, and the player's own moves as player1_moves
+
+    Args:
+        data (dict): The event's fields (see events.EVENT_FIELDS)
+        user_id (str): The provider ID of the player viewing it
+        player1 (str): The provider ID of the game's player1
+    '''
+    data = dict(data)
+    if 'player1' in data:
+        users_by_id = cache.get_users({data['player1'], data['player2']} - {None})
+        for user in users_by_id.values():
+            user.pop('_id', None)
+        data['player1'] = users_by_id.get(data['player1'])
+        data['player2'] = users_by_id.get(data['player2'])
+
+    if user_id != player1:
+        if 'player1' in data:
+            data['player1'], data['player2'] = data['player2'], data['player1']
+        if 'player1_moves' in data:
+            data['player1_moves'], data['player2_moves'] = data['player2_moves'], data['player1_moves']
+
+    return data
+
+def enrich_games(games, user_id, users_by_id=None):
+    '''
+    Replaces the player ids in each game with their user docs (the uncached ones fetched in one query,
+    unless given), and swaps players so the caller is always player1
+    '''
+    if users_by_id is None:
+        provider_ids = {game['player1'] for game in games} | {game['player2'] for game in games}
+        provider_ids.discard(None)
+        users_by_id = cache.get_users(provider_ids)
+    for user in users_by_id.values():
+        user.pop('_id', None)
+
+    for game in games:
+        game['player1'] = users_by_id.get(game['player1'])
+        game['player2'] = users_by_id.get(game['player2'])
 
         # Swap players so caller is always player1
-        if user_id != game['player1']['provider_id']:
+        if not game['player1'] or user_id != game['player1']['provider_id']:
             game['player1'], game['player2'] = game['player2'], game['player1']
             game['player1_moves'], game['player2_moves'] = game['player2_moves'], game['player1_moves']
         # TODO: Crop player2's guesses in case they're ahead
 
-    return utils.safe_bson(response), 200
+    return games
 
-def get_game(game_id, user_id):
+def game_etag(game, users_by_id, user_id):
     '''
-    Gets the full details for a game
+    ETag for a loaded game (see load_game), from the game's version and both players' user versions.
+    Includes the caller since the response is from their point of view.
     '''
-    game = db.games.find_one({'_id': bson.ObjectId(game_id)})
-    if not game:
-        return {'error': 'Game not found'}, 404
+    return _etag(user_id, game['_id'], game.get('version', 0), *_user_versions(users_by_id))
 
-    if user_id != game['player1'] and user_id != game['player2']:
-        return {'error': 'User not involved in game'}, 403
+def get_games_etag(user_id, archive_offset=0, archive_limit=10):
+    '''
+    ETag for get_games, combining every active game's version with the user versions of the caller
+    and of the opponents in the response (active games and the archive page).
+    Games only enter the archive by leaving the active list, so that covers the archive page's games too.
+    '''
+    user = cache.get_user(user_id)
+    if not user:
+        return {'error': 'User not found'}, 404
+
+    games = list(db.games.find(
+        {'$or': [{'player1': user_id}, {'player2': user_id}]},
+        {'version': 1, 'player1': 1, 'player2': 1},
+    ))
+    opponents = {game['player2'] if game['player1'] == user_id else game['player1'] for game in games} - {None}
+    opponents |= archive.get_opponents(user_id, archive_offset, archive_limit)
+    players = cache.get_users(opponents | {user_id})
 
-    # Enrich game with user details
-    game['player1'] = utils.safe_bson(db.users.find_one({'provider_id': game['player1']}, {'_id': 0}))
-    game['player2'] = utils.safe_bson(db.users.find_one({'provider_id': game['player2']}, {'_id': 0}))
+    parts = [user_id, archive_offset, archive_limit, *_user_versions(players)]
+    parts += sorted(f"{game['_id']}:{game.get('version', 0)}" for game in games)
 
-    # Swap players so caller is always player1
-    if user_id != game['player1']['provider_id']:
-        game['player1'], game['player2'] = game['player2'], game['player1']
-        game['player1_moves'], game['player2_moves'] = game['player2_moves'], game['player1_moves']
+    return _etag(*parts), 200
 
-    # TODO: Crop player2's guesses in case they're ahead
+def _user_versions(users_by_id):
+    return sorted(f"{provider_id}:{user.get('version', 0)}" for provider_id, user in users_by_id.items())
 
-    return utils.safe_bson(game), 200
+def _etag(*parts):
+    return hashlib.sha1(':'.join(str(part) for part in parts).encode()).hexdigest()
 
 def get_game_by_phrase(game_phrase, user_id):
     '''
     Gets a game by its key phrase
     '''
-    game = db.games.find_one({'key_phrase': game_phrase})
+    game = cache.get_game_by_phrase(game_phrase)
 
     # If game not found, return error
     if not game:
@@ -179,20 +294,21 @@ def get_game_by_phrase(game_phrase, user_id):
 
     # If player in game, return game
     if user_id == game['player1'] or user_id == game['player2']:
-        return utils.safe_bson(game), 200
+        return game, 200
 
     # If game full already and user not involved, return error
     if game['player2'] and user_id != game['player1'] and user_id != game['player2']:
         return {'error': 'Game not found'}, 403
 
-    return utils.safe_bson(game), 200
+    return game, 200
 
 def add_move(game_id, user_id, word):
     '''
-    Adds a user's move to a game
-    '''
-    print('adding move to game:', game_id, user_id, word)
+    Adds a user's move to a game.
 
+    The turn, membership and in-progress checks are part of the update filter, so the move,
+    round completion and the finished transition all happen in one atomic find_one_and_update.
+    '''
     # Check valid input
     if not game_id:
         return {'error': 'No game id provided'}, 400
@@ -203,8 +319,73 @@ def add_move(game_id, user_id, word):
     if not word:
         return {'error': 'No word provided'}, 400
 
-    # Check game exists
-    game = db.games.find_one({'_id': bson.ObjectId(game_id)})
+    # The word model loads in the background after startup
+    if ling.status()['state'] == 'failed':
+        return {'error': 'The word model failed to load'}, 500
+    if not ling.wait_ready(LING_READY_TIMEOUT):
+        return {'error': 'The word model is still loading, try again shortly'}, 503
+
+    # Check word is valid
+    if not ling.validate_word(word):
+        return {'error': 'Invalid word. Must appear in the word set.'}, 400
+
+    # Only matches if the user is in the game and isn't ahead of the other player
+    p1_size = {'$size': '$player1_moves'}
+    p2_size = {'$size': '$player2_moves'}
+    query = {
+        '_id': bson.ObjectId(game_id),
+        'game_state': 'in_progress',
+        '$or': [
+            {'player1': user_id, '$expr': {'$lte': [p1_size, p2_size]}},
+            {'player2': user_id, '$expr': {'$lte': [p2_size, p1_size]}},
+        ],
+    }
+
+    # Append the word to the caller's moves, then work out the round/game state from the new arrays
+    is_player1 = {'$eq': ['$player1', {'$literal': user_id}]}
+    round_complete = {'$eq': [p1_size, p2_size]}
+    words_match = {'$eq': [{'$arrayElemAt': ['$player1_moves', -1]}, {'$arrayElemAt': ['$player2_moves', -1]}]}
+    pipeline = [
+        {'$set': {
+            'player1_moves': {'$cond': [is_player1, {'$concatArrays': ['$player1_moves', [word]]}, '$player1_moves']},
+            'player2_moves': {'$cond': [is_player1, '$player2_moves', {'$concatArrays': ['$player2_moves', [word]]}]},
+            'updated_at': datetime.now(),
+            'updated_by': {'$literal': user_id},
+            'version': {'$add': [{'$ifNull': ['$version', 0]}, 1]},
+            'changed_at': utils.utcnow(),
+        }},
+        {'$set': {
+            'score_pending': {'$cond': [round_complete, True, {'$ifNull': ['$score_pending', False]}]},
+            'game_state': {'$cond': [{'$and': [round_complete, words_match]}, 'finished', '$game_state']},
+        }},
+    ]
+
+    game = db.games.find_one_and_update(query, pipeline, return_document=ReturnDocument.AFTER)
+    if not game:
+        return _move_rejection(game_id, user_id)
+
+    cache.put_game(game)
+    events.publish(game, 'move')
+
+    # Only the move that finishes the game matches the in_progress filter in this state
+    if game['game_state'] == 'finished':
+        stats.record_finish(game)
+
+    # Score the round in the background, the game shows score_pending until then
+    if len(game['player1_moves']) == len(game['player2_moves']):
+        scoring.submit(game_id)
+
+    return game, 200
+
+
+def _move_rejection(game_id, user_id):
+    '''
+    Work out why add_move's conditional update didn't match
+    '''
+    game = db.games.find_one(
+        {'_id': bson.ObjectId(game_id)},
+        {'player1': 1, 'player2': 1, 'game_state': 1},
+    )
     if not game:
         return {'error': 'Game not found'}, 404
 
@@ -214,73 +395,10 @@ def add_move(game_id, user_id, word):
 
     # Check game is in progress
     if game['game_state'] != 'in_progress':
-        print('breaking because game is not in progress')
         return {'error': 'Game is not in progress'}, 400
 
-    # Check it's the user's turn
-    if user_id == game['player1']:
-        if len(game['player1_moves']) > len(game['player2_moves']):
-            print('breaking because player 1 is already ahead')
-            return {'error': 'Waiting for user to submit their move'}, 400
-    else:
-        if len(game['player2_moves']) > len(game['player1_moves']):
-            print('breaking because player 2 is already ahead')
-            return {'error': 'Waiting for user to submit their move'}, 400
-
-    # Check word is valid
-    if not ling.validate_word(word):
-        return {'error': 'Invalid word. Must appear in the word set.'}, 400
-
-    # Add move to game
-    moves_key = 'player1_moves' if user_id == game['player1'] else 'player2_moves'
-    payload = {
-        '$push': {
-            moves_key: word
-        },
-        '$set': {
-            'updated_at': datetime.now(),
-            'updated_by': user_id,
-        },
-    }
-
-    # Check if the game is over
-    if len(game['player1_moves']) > 0 and (len(game['player1_moves']) == len(game['player2_moves'])):
-        if game['player1_moves'][-1] == game['player2_moves'][-1]:
-            payload['$set'] = {'game_state': 'finished'}
-    
-
-    # Make update
-    result = db.games.update_one(
-        {'_id': bson.ObjectId(game_id)},
-        payload,
-    )
-    print('doc update result:', result)
-
-    if result.modified_count == 0:
-        return {'error': 'Failed to add move'}, 500
-
-    # Check if score can be updated
-    game = db.games.find_one({'_id': bson.ObjectId(game_id)})
-    if len(game['player1_moves']) > 0 and (len(game['player1_moves']) == len(game['player2_moves'])):
-        if len(game['scores']) < len(game['player1_moves']):
-            ling_result = ling.score_words(game['player1_moves'][-1], game['player2_moves'][-1])
-            if ling_result:
-                print('ling result:', ling_result)
-                payload = {
-                    '$push': {
-                        'scores': ling_result['score'],
-                        'optimal_moves': ling_result['optimal'],
-                    }
-                }
-                result = db.games.update_one(
-                    {'_id': bson.ObjectId(game_id)},
-                    payload,
-                )
-
-                if result.modified_count == 0:
-                    return {'error': 'Failed to add score'}, 500
-
-    return utils.safe_bson(game), 200
+    # Otherwise the user is already ahead
+    return {'error': 'Waiting for user to submit their move'}, 400
 
 
 def quit_game(game_id, user_id):
@@ -0,0 +1,68 @@
+'''
+Production entry point:
+    gunicorn -c gunicorn.conf.py server:app
+
+The app is imported once in the master, which starts loading the ling embeddings. The master binds
+the port and waits for that load before forking any workers (requests queue on the socket meanwhile,
+which is brief once the cache is built). So the vocabulary and prefix index are loaded once and shared
+copy-on-write, and the memory-mapped embedding matrix is shared through the OS page cache.
+Each worker connects to Mongo after the fork. The dev server (python server.py) keeps loading in the
+background and serves /readyz meanwhile.
+
+Workers are gevent workers, so an open GET /games/<id>/events stream is a parked greenlet rather
+than a thread, and idle viewers don't use up a worker. Round scoring runs its vocabulary scan on
+gevent's native threadpool (see scoring.py), so it doesn't block the worker's other requests.
+Set GUNICORN_WORKER_CLASS=gthread (with GUNICORN_THREADS) to go back to threads.
+
+Each worker picks up game changes made by the others for its event streams (GAME_EVENTS_SOURCE,
+see events.py). GAME_EVENTS_SOURCE=local only reaches streams on the worker that made the change,
+so it refuses to start with more than one worker.
+'''
+import os
+import gc
+import multiprocessing
+
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gevent')
+if worker_class == 'gevent':
+    # Patch before the app is preloaded, so the locks, events and queues it creates
+    # at import cooperate with greenlets
+    from gevent import monkey
+    monkey.patch_all()
+
+events_source = os.getenv('GAME_EVENTS_SOURCE', 'poll')
+
+bind = f"{os.getenv('HOST', '127.0.0.1')}:{os.getenv('PORT', 3024)}"
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+threads = int(os.getenv('GUNICORN_THREADS', 4))
+worker_connections = int(os.getenv('GUNICORN_CONNECTIONS', 1000))
+preload_app = True
+timeout = 120
+
+if workers > 1 and events_source == 'local':
+    raise RuntimeError(
+        f'WEB_CONCURRENCY={workers} with GAME_EVENTS_SOURCE=local: game events would only reach '
+        'streams on the worker that made the change. Use GAME_EVENTS_SOURCE=poll (the default) '
+        'or changestream, or run a single worker.'
+    )
+
+
+def when_ready(server):
+    import ling
+
+    # Finish the load the app import started before any worker is forked
+    while not ling.wait_ready(1):
+        status = ling.status()
+        if status['state'] == 'failed':
+            raise RuntimeError(f"Failed to load the embeddings: {status['error']}")
+
+
+def pre_fork(server, worker):
+    # Keep the garbage collector from touching (and so copying) objects loaded in the master,
+    # like ling's word index
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    from mongoInterface import db
+
+    db.reset()
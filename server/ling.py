@@ -1,74 +1,622 @@
+import os
+import json
+import bisect
+import fcntl
+import hashlib
+import inspect
+import argparse
+import threading
+import traceback
 import numpy as np
 
+# Local imports
+import metrics
 
-FPATH = 'glove.6B.100d.txt'
-wordset = {}
-with open(FPATH, 'r', encoding='utf-8') as f:
-    for line in f:
-        parts = line.strip().split()
-        word = parts[0]
 
-        if len(word) < 3:
-            continue
-        if not word.isalpha() or not word.isascii():
-            continue
+FPATH = os.getenv('GLOVE_PATH', 'glove.6B.100d.txt')
+CACHE_DIR = os.path.splitext(FPATH)[0] + '.cache'
 
-        # TODO: Filter the original dataset for this instead
-        # TODO: Also filter for english words only
+# Optional word lists (one word per line, see build_vocab.py):
+#   - VALID_VOCAB: the words accepted as moves (default: every word kept by keep_word)
+#   - PLAYABLE_VOCAB: the words optimal_word can answer with (default: every valid word)
+# Playable words are stored first, so searches only scan the top rows of the matrix.
+VALID_VOCAB = os.getenv('LING_VALID_VOCAB')
+PLAYABLE_VOCAB = os.getenv('LING_PLAYABLE_VOCAB')
 
-        vec = np.array(parts[1:], dtype=np.float32)
-        wordset[word] = vec
+# Midpoint search mode for optimal_word: 'exact' scans every row, 'ivf' uses the
+# inverted file index built with `python ling.py build-index`.
+# NPROBE is the speed/recall knob for 'ivf': the number of lists scanned per query.
+SEARCH_MODE = os.getenv('LING_SEARCH', 'exact')
+NPROBE = int(os.getenv('LING_NPROBE', 8))
 
+# Storage for the normalized matrix: 'float32', 'float16', or 'int8' (with a per-row scale)
+STORAGE = os.getenv('LING_STORAGE', 'float32')
+STORAGE_FILES = {
+    'float32': 'vectors.npy',
+    'float16': 'vectors.f16.npy',
+    'int8': 'vectors.i8.npy',
+}
 
-print(f'Built wordset of {len(wordset):,} words')
+# Bump when the cache layout changes
+CACHE_FORMAT = 4
+
+# Rows per block when dequantizing float16/int8 for a matrix-vector product
+CHUNK_ROWS = 32768
+
+
+def keep_word(word):
+    '''
+    Filter rules for which GloVe tokens make it into the wordset.
+    Changing this function invalidates the embedding cache.
+    '''
+    if len(word) < 3:
+        return False
+    if not word.isalpha() or not word.isascii():
+        return False
+
+    # Curated lists (dictionary words, no stopwords, rank caps) come from build_vocab.py
+    # through LING_VALID_VOCAB and LING_PLAYABLE_VOCAB
+
+    return True
+
+
+def read_word_list(path):
+    '''
+    Words from a word list file: one per line, lowercased, blank lines and # comments skipped
+    '''
+    with open(path, encoding='utf-8') as f:
+        lines = (line.split('#', 1)[0].strip().lower() for line in f)
+        return [line for line in lines if line]
+
+
+def _file_hash(path):
+    if not path:
+        return None
+
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def cache_key():
+    '''
+    Identifies the source file and filter rules a cache was built from
+    '''
+    stat = os.stat(FPATH)
+    return {
+        'format': CACHE_FORMAT,
+        'source': os.path.abspath(FPATH),
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'filter': hashlib.sha1(inspect.getsource(keep_word).encode()).hexdigest(),
+        'valid_vocab': _file_hash(VALID_VOCAB),
+        'playable_vocab': _file_hash(PLAYABLE_VOCAB),
+    }
+
+
+def cache_is_fresh():
+    try:
+        with open(os.path.join(CACHE_DIR, 'meta.json')) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return False
+
+    return meta.get('key') == cache_key()
+
+
+def build_cache():
+    '''
+    One-time conversion of the GloVe text file into:
+        - vectors.npy: (V, d) float32 matrix of row-normalized vectors
+        - vectors.f16.npy: the same matrix as float16
+        - vectors.i8.npy, scales.npy: the same matrix as int8, with a float32 scale per row
+        - norms.npy: (V,) float32 original vector norms
+        - vocab.txt: the word for each row, one per line
+        - meta.json: the cache key, model id and number of playable rows, written last so a partial build is never loaded
+
+    Rows keep GloVe's frequency order, with the playable words first.
+    '''
+    valid = set(read_word_list(VALID_VOCAB)) if VALID_VOCAB else None
+    playable = set(read_word_list(PLAYABLE_VOCAB)) if PLAYABLE_VOCAB else None
+
+    words = []
+    vectors = []
+    total = os.path.getsize(FPATH)
+    done = 0
+    source_hash = hashlib.sha1()
+    with open(FPATH, 'rb') as f:
+        for i, raw in enumerate(f):
+            done += len(raw)
+            source_hash.update(raw)
+            if i % 10000 == 0:
+                _set_status('building cache', done / total)
+
+            parts = raw.decode('utf-8').strip().split()
+            if not parts or not keep_word(parts[0]):
+                continue
+            if valid is not None and parts[0] not in valid:
+                continue
+
+            words.append(parts[0])
+            vectors.append(np.array(parts[1:], dtype=np.float32))
+
+    vectors = np.stack(vectors).astype(np.float32)
+
+    n_playable = len(words)
+    if playable is not None:
+        is_playable = np.array([word in playable for word in words])
+        order = np.concatenate([np.flatnonzero(is_playable), np.flatnonzero(~is_playable)])
+        words = [words[i] for i in order]
+        vectors = vectors[order]
+        n_playable = int(is_playable.sum())
+
+    norms = np.linalg.norm(vectors, axis=1).astype(np.float32)
+    vectors /= norms[:, None]
+
+    scales = (np.abs(vectors).max(axis=1) / 127).astype(np.float32)
+    quantized = np.round(vectors / scales[:, None]).astype(np.int8)
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    arrays = [
+        ('vectors.npy', vectors),
+        ('vectors.f16.npy', vectors.astype(np.float16)),
+        ('vectors.i8.npy', quantized),
+        ('scales.npy', scales),
+        ('norms.npy', norms),
+    ]
+    for name, arr in arrays:
+        tmp = os.path.join(CACHE_DIR, name + '.tmp')
+        with open(tmp, 'wb') as f:
+            np.save(f, arr)
+        os.replace(tmp, os.path.join(CACHE_DIR, name))
+
+    tmp = os.path.join(CACHE_DIR, 'vocab.txt.tmp')
+    with open(tmp, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(words))
+    os.replace(tmp, os.path.join(CACHE_DIR, 'vocab.txt'))
+
+    # Identifies the embeddings and vocabulary that scores come from (not where the file lives)
+    key = cache_key()
+    model = hashlib.sha1(json.dumps(
+        [source_hash.hexdigest(), key['filter'], key['valid_vocab'], key['playable_vocab']],
+    ).encode()).hexdigest()
+    model = f'{os.path.splitext(os.path.basename(FPATH))[0]}-{model[:10]}'
+
+    tmp = os.path.join(CACHE_DIR, 'meta.json.tmp')
+    with open(tmp, 'w') as f:
+        json.dump({'key': key, 'model': model, 'words': len(words), 'playable': n_playable, 'dim': vectors.shape[1]}, f)
+    os.replace(tmp, os.path.join(CACHE_DIR, 'meta.json'))
+
+    print(f'Built embedding cache of {len(words):,} words ({n_playable:,} playable) in {CACHE_DIR}')
+
+
+def ensure_cache():
+    '''
+    Rebuild the cache if the source file or filter rules changed.
+    Takes a file lock so concurrent processes only convert once.
+    '''
+    if cache_is_fresh():
+        return
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(os.path.join(CACHE_DIR, '.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if not cache_is_fresh():
+                build_cache()
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def build_index(nlist=1024, iterations=10, sample_size=100_000, seed=0):
+    '''
+    Build an inverted file (IVF) index over the playable rows and save it to ivf.npz:
+        - centroids: (nlist, d) unit vectors from spherical k-means
+        - order: row ids grouped by their nearest centroid
+        - offsets: list i holds order[offsets[i]:offsets[i + 1]]
+    '''
+    rng = np.random.default_rng(seed)
+    n_rows = search_rows
+    nlist = min(nlist, n_rows)
+
+    sample = take(np.sort(rng.choice(n_rows, min(sample_size, n_rows), replace=False)))
+    centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+
+    for _ in range(iterations):
+        assign = _assign(sample, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, sample)
+
+        # Re-seed empty lists with random sample rows
+        empty = np.bincount(assign, minlength=nlist) == 0
+        sums[empty] = sample[rng.choice(len(sample), int(empty.sum()))]
+        centroids = sums / np.linalg.norm(sums, axis=1, keepdims=True)
+
+    assign = np.concatenate([
+        _assign(take(slice(start, start + CHUNK_ROWS)), centroids)
+        for start in range(0, n_rows, CHUNK_ROWS)
+    ])
+    order = np.argsort(assign, kind='stable')
+    offsets = np.zeros(nlist + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(assign, minlength=nlist))
+
+    np.savez(
+        os.path.join(CACHE_DIR, 'ivf.npz'),
+        centroids=centroids.astype(np.float32),
+        order=order.astype(np.int64),
+        offsets=offsets,
+        key=json.dumps(cache_key()),
+    )
+    print(f'Built IVF index with {nlist} lists over {n_rows:,} words')
+
+
+def _assign(rows, centroids, batch=16384):
+    '''
+    Index of the most similar centroid for each row
+    '''
+    assign = np.empty(len(rows), dtype=np.int64)
+    for start in range(0, len(rows), batch):
+        assign[start:start + batch] = np.argmax(rows[start:start + batch] @ centroids.T, axis=1)
+
+    return assign
+
+
+def load_index():
+    '''
+    Load the IVF index if one was built for the current cache
+    '''
+    global ivf
+
+    ivf = None
+    path = os.path.join(CACHE_DIR, 'ivf.npz')
+    if not os.path.exists(path):
+        return
+
+    data = np.load(path)
+    if json.loads(str(data['key'])) != cache_key():
+        print('IVF index is stale, rebuild it with `python ling.py build-index`')
+        return
+
+    ivf = {name: data[name] for name in ['centroids', 'order', 'offsets']}
+
+
+def load():
+    '''
+    Memory-map the cached embeddings (building the cache first if needed)
+    '''
+    global words, word_index, matrix, scales, norms, search_rows, model_id, prefix_words, prefix_rows
+
+    if STORAGE not in STORAGE_FILES:
+        raise ValueError(f'Unknown LING_STORAGE: {STORAGE} (expected one of {list(STORAGE_FILES)})')
+
+    _set_status('loading', 0.0)
+    ensure_cache()
+    matrix = np.load(os.path.join(CACHE_DIR, STORAGE_FILES[STORAGE]), mmap_mode='r')
+    scales = np.load(os.path.join(CACHE_DIR, 'scales.npy'), mmap_mode='r') if STORAGE == 'int8' else None
+    norms = np.load(os.path.join(CACHE_DIR, 'norms.npy'), mmap_mode='r')
+    with open(os.path.join(CACHE_DIR, 'vocab.txt'), encoding='utf-8') as f:
+        words = f.read().split('\n')
+    word_index = {word: i for i, word in enumerate(words)}
+    with open(os.path.join(CACHE_DIR, 'meta.json')) as f:
+        meta = json.load(f)
+    search_rows = meta['playable']
+    model_id = meta['model']
+    prefix_rows = np.array(sorted(range(len(words)), key=words.__getitem__), dtype=np.int32)
+    prefix_words = [words[i] for i in prefix_rows]
+    load_index()
+
+    _set_status('ready', 1.0)
+    _ready.set()
+    print(f'Loaded wordset of {len(words):,} words ({search_rows:,} playable)')
+
+
+def start_loading():
+    '''
+    Load the embeddings on a background thread, once per process.
+    A process forked mid-load starts its own load (gunicorn.conf.py waits for the load before forking workers).
+    '''
+    global _loader_pid
+
+    with _status_lock:
+        if _ready.is_set() or _loader_pid == os.getpid():
+            return
+        _loader_pid = os.getpid()
+        _status['state'] = 'loading'
+
+    threading.Thread(target=_load_in_background, name='ling-load', daemon=True).start()
+
+
+def _load_in_background():
+    try:
+        load()
+    except Exception as e:
+        print('Failed to load embeddings:')
+        print(traceback.format_exc())
+        _set_status('failed', error=str(e))
+
+
+def wait_ready(timeout=None):
+    '''
+    Wait for the embeddings to load.
+
+    Returns:
+        bool: Whether they are loaded
+    '''
+    return _ready.wait(timeout)
+
+
+def status():
+    '''
+    Loading state for the readiness endpoint
+    '''
+    with _status_lock:
+        return dict(_status, words=len(words))
+
+
+def _set_status(state, progress=None, error=None):
+    with _status_lock:
+        _status['state'] = state
+        if progress is not None:
+            _status['progress'] = round(progress, 3)
+        _status['error'] = error
+
+
+# Contiguous (V, d) matrix with a parallel word list.
+# Rows are pre-normalized so a single matrix-vector product gives cosine similarities.
+# For int8 storage a row is matrix[i] * scales[i].
+# Nothing is loaded on import: call load() (blocking) or start_loading() (background).
+words = []
+word_index = {}
+matrix = None
+scales = None
+norms = None
+ivf = None
+
+# Rows [0, search_rows) are the playable words that optimal_word searches
+search_rows = 0
+
+# Tags the scores computed with the loaded embeddings and vocabulary
+model_id = None
+
+# The vocabulary in sorted order (and each word's row) for prefix lookups.
+# Row order is GloVe's frequency order (playable words first), so lower rows are more common words.
+prefix_words = []
+prefix_rows = None
+
+_ready = threading.Event()
+_status = {'state': 'not started', 'progress': 0.0, 'error': None}
+_status_lock = threading.Lock()
+_loader_pid = None
+
+
+def _after_fork():
+    # The loader thread doesn't survive a fork and may have held the lock
+    global _status_lock
+    _status_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_after_fork)
 
 
 def validate_word(word):
     '''
     Check a word is valid (appears in embedding set)
     '''
-    return word in wordset
+    return word in word_index
+
+def complete(prefix, limit=10):
+    '''
+    The most common words starting with a prefix, most common first
+    (playable words rank ahead of the rest, as they come first in the matrix)
+    '''
+    lo = bisect.bisect_left(prefix_words, prefix)
+    hi = bisect.bisect_left(prefix_words, prefix + '\U0010ffff', lo)
+    rows = prefix_rows[lo:hi]
+    if len(rows) > limit:
+        rows = rows[np.argpartition(rows, limit)[:limit]]
+
+    return [words[i] for i in np.sort(rows)]
+
+def vector(word):
+    '''
+    Get the original (un-normalized) vector for a word
+    '''
+    i = word_index[word]
+    return take(i) * norms[i]
+
+def take(rows):
+    '''
+    Normalized float32 rows of the matrix for an index, slice, or array of row ids
+    '''
+    block = np.asarray(matrix[rows], dtype=np.float32)
+    if scales is not None:
+        block *= np.asarray(scales[rows], dtype=np.float32)[..., None]
+
+    return block
+
+def similarities(query, rows=None):
+    '''
+    Dot product of the query with every playable row (or the given row ids), computed
+    directly on the stored matrix. float16/int8 blocks are widened in chunks.
+    '''
+    query = np.asarray(query, dtype=np.float32)
+    if matrix.dtype == np.float32:
+        return np.asarray((matrix[:search_rows] if rows is None else matrix[rows]) @ query)
+
+    n_rows = search_rows if rows is None else len(rows)
+    sims = np.empty(n_rows, dtype=np.float32)
+    for start in range(0, n_rows, CHUNK_ROWS):
+        index = slice(start, start + CHUNK_ROWS) if rows is None else rows[start:start + CHUNK_ROWS]
+        block = np.asarray(matrix[index], dtype=np.float32) @ query
+        if scales is not None:
+            block *= scales[index]
+        sims[start:start + CHUNK_ROWS] = block
+
+    return sims
 
 def cos(a, b):
     return np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b))
 
-def optimal_word(a, b, a_vec, b_vec):
+def optimal_word(a, b, a_vec, b_vec, exclude=()):
     '''
-    Find the optimal word between two words
+    Find the optimal word between two words, out of the playable words
+    that aren't the guesses or in exclude
     '''
     if a == b:
         return a
 
+    best = optimal_words(a_vec, b_vec, 1, {a, b, *exclude})
+    return best[0][0] if best else None
+
+@metrics.timed_function('ling.optimal_word')
+def optimal_words(a_vec, b_vec, k=1, exclude=()):
+    '''
+    The k playable words closest to the midpoint of two vectors, skipping the words in exclude.
+    Uses a partial sort, so it costs about the same as finding just the best one.
+
+    Returns:
+        list: (word, cosine similarity to the midpoint) pairs, best first, positive similarities only
+    '''
     middle = (a_vec + b_vec) / 2
-    closest = None
-    closest_dist = 0
+    length = np.linalg.norm(middle)
+    if not length > 0:
+        return []
+
+    rows, sims = _candidates(middle / length)
+
+    # Mask out the excluded words (if they're playable words)
+    excluded = [word_index[word] for word in exclude if word_index.get(word, search_rows) < search_rows]
+    if rows is None:
+        sims[excluded] = -np.inf
+    else:
+        sims[np.isin(rows, excluded)] = -np.inf
+
+    k = min(k, len(sims))
+    if k < 1:
+        return []
+    top = np.argpartition(sims, len(sims) - k)[-k:]
+    top = top[np.argsort(sims[top])[::-1]]
 
-    for word, vec in wordset.items():
-        if word in [a, b]:
-            continue
+    return [
+        (words[i if rows is None else rows[i]], float(sims[i]))
+        for i in top if sims[i] > 0
+    ]
 
-        dist = cos(middle, vec)
-        if dist > closest_dist:
-            closest_dist = dist
-            closest = word
+def _candidates(query):
+    '''
+    Rows to consider for a midpoint query and their similarity to it.
+    Scans every playable row in 'exact' mode (rows is None), or the NPROBE closest lists in 'ivf' mode.
+    '''
+    if SEARCH_MODE == 'ivf' and ivf is not None:
+        lists = np.argsort(ivf['centroids'] @ query)[-NPROBE:]
+        offsets = ivf['offsets']
+        rows = np.sort(np.concatenate([ivf['order'][offsets[i]:offsets[i + 1]] for i in lists]))
+        return rows, similarities(query, rows)
 
-    return closest
+    return None, similarities(query)
 
-def score_words(word1, word2):
+@metrics.timed_function('ling.score_words')
+def score_words(word1, word2, exclude=(), k=1):
     '''
     Score two words.
     Returns:
         - the cosine similarity between the two words
-        - the optimal word (word between the two guesses)
+        - the optimal word (word between the two guesses), which isn't one of the guesses or in exclude
+        - the top k candidates for the optimal word, as (word, similarity) pairs
     '''
-    a_vec = wordset[word1]
-    b_vec = wordset[word2]
-    
+    a_vec = vector(word1)
+    b_vec = vector(word2)
+
     score = float(cos(a_vec, b_vec))
-    optimal = optimal_word(word1, word2, a_vec, b_vec)
+    if word1 == word2:
+        candidates = []
+        optimal = word1
+    else:
+        candidates = optimal_words(a_vec, b_vec, k, {word1, word2, *exclude})
+        optimal = candidates[0][0] if candidates else None
 
     return {
         'score': score,
         'optimal': optimal,
+        'candidates': candidates,
     }
 
+def score_pairs(rows1, rows2, exclude=None, k=1, block_elements=8 * 1024 * 1024):
+    '''
+    score_words for many pairs at once, by row id (exact search).
+    The midpoints of every pair are scanned against blocks of playable rows with one
+    matrix-matrix product per block, keeping each block's (rows x pairs) similarities
+    under block_elements floats.
+
+    Args:
+        exclude (list): Optional rows to skip for each pair, on top of its guesses
+        k (int): The number of candidates to return per pair
+
+    Returns:
+        np.ndarray: the cosine similarity of each pair
+        np.ndarray: (pairs, k) rows of each pair's best candidates, best first, -1 padded.
+            The first is the optimal word (the guess itself if both guesses are the same).
+    '''
+    rows1 = np.asarray(rows1, dtype=np.int64)
+    rows2 = np.asarray(rows2, dtype=np.int64)
+    n_pairs = len(rows1)
+    a = take(rows1)
+    b = take(rows2)
+    scores = np.einsum('ij,ij->i', a, b)
+
+    # Midpoints of the original vectors, normalized so similarities are comparable across pairs
+    middle = a * np.asarray(norms[rows1])[:, None] + b * np.asarray(norms[rows2])[:, None]
+    lengths = np.linalg.norm(middle, axis=1, keepdims=True)
+    middle = np.divide(middle, lengths, out=np.zeros_like(middle), where=lengths > 0)
+
+    # (row, pair) positions to mask out
+    pair_ids = np.arange(n_pairs)
+    masked_rows = [rows1, rows2]
+    masked_pairs = [pair_ids, pair_ids]
+    for i, rows in enumerate(exclude or []):
+        masked_rows.append(np.asarray(rows, dtype=np.int64))
+        masked_pairs.append(np.full(len(rows), i))
+    masked_rows = np.concatenate(masked_rows)
+    masked_pairs = np.concatenate(masked_pairs)
+
+    # Running top k per pair, only positive similarities qualify
+    top = np.full((k, n_pairs), -1, dtype=np.int64)
+    top_sims = np.zeros((k, n_pairs), dtype=np.float32)
+    block_rows = max(1024, k, block_elements // max(n_pairs, 1))
+    for start in range(0, search_rows, block_rows):
+        stop = min(start + block_rows, search_rows)
+        sims = take(slice(start, stop)) @ middle.T
+
+        inside = (masked_rows >= start) & (masked_rows < stop)
+        sims[masked_rows[inside] - start, masked_pairs[inside]] = -np.inf
+
+        if k == 1:
+            block_top = np.argmax(sims, axis=0)[None]
+        else:
+            block_k = min(k, stop - start)
+            block_top = np.argpartition(sims, len(sims) - block_k, axis=0)[-block_k:]
+        rows = np.concatenate([top, block_top + start])
+        row_sims = np.concatenate([top_sims, np.take_along_axis(sims, block_top, axis=0)])
+        keep = np.argpartition(row_sims, len(row_sims) - k, axis=0)[-k:]
+        top = np.take_along_axis(rows, keep, axis=0)
+        top_sims = np.take_along_axis(row_sims, keep, axis=0)
+
+    order = np.argsort(-top_sims, axis=0, kind='stable')
+    top = np.take_along_axis(top, order, axis=0).T
+    top[np.take_along_axis(top_sims, order, axis=0).T <= 0] = -1
+
+    same = rows1 == rows2
+    top[same] = -1
+    top[same, 0] = rows1[same]
+
+    return scores, top
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the embedding cache and search index')
+    parser.add_argument('command', nargs='?', default='build-cache', choices=['build-cache', 'build-index'])
+    parser.add_argument('--nlist', type=int, default=1024, help='Number of IVF lists')
+    parser.add_argument('--iterations', type=int, default=10, help='k-means iterations')
+    args = parser.parse_args()
+
+    load()
+    print(f'Embedding cache is up to date in {CACHE_DIR}')
+    if args.command == 'build-index':
+        build_index(nlist=args.nlist, iterations=args.iterations)
@@ -0,0 +1,138 @@
+'''
+Storage for the link board (/links, /add, /delete/<idx>).
+
+Links live in a SQLite table keyed by an autoincrementing sequence, so adding is an
+append, deleting is a single-row delete, and a page of the newest links is read
+through the primary key without loading the rest of the board. WAL mode keeps reads
+going during writes and makes every write an atomic, durable transaction; the busy
+timeout serializes writers from other threads and processes.
+
+An existing data.json is imported the first time the database is opened
+(or explicitly with `python linkboard.py migrate [path]`).
+'''
+import os
+import sys
+import json
+import uuid
+import sqlite3
+import threading
+from datetime import datetime
+from datetime import timezone
+
+DIR = os.path.dirname(os.path.abspath(__file__))
+DB_FILE = os.path.join(DIR, 'links.db')
+LEGACY_FILE = os.path.join(DIR, 'data.json')
+
+_local = threading.local()
+
+
+def connection():
+    '''
+    One connection per thread (and per process, connections can't cross a fork)
+    '''
+    conn = getattr(_local, 'conn', None)
+    if conn is None or _local.pid != os.getpid():
+        conn = sqlite3.connect(DB_FILE, timeout=10, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=FULL')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS links (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                idx TEXT NOT NULL UNIQUE,
+                link TEXT NOT NULL,
+                date TEXT NOT NULL
+            )
+        ''')
+        _local.conn = conn
+        _local.pid = os.getpid()
+
+        if os.path.exists(LEGACY_FILE):
+            migrate(LEGACY_FILE)
+
+    return conn
+
+
+def migrate(path):
+    '''
+    Import a data.json board (newest first) if the table is still empty,
+    then rename the file so it isn't imported again.
+
+    Returns:
+        int: The number of links imported
+    '''
+    conn = connection()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        if conn.execute('SELECT 1 FROM links LIMIT 1').fetchone():
+            conn.execute('ROLLBACK')
+            return 0
+
+        with open(path) as file:
+            content = file.read()
+        data = json.loads(content) if content.strip() else []
+
+        # Oldest first so the sequence keeps the board's order
+        conn.executemany(
+            'INSERT OR IGNORE INTO links (idx, link, date) VALUES (?, ?, ?)',
+            [(item['idx'], item['link'], item['date']) for item in reversed(data)],
+        )
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+
+    if os.path.exists(path):
+        os.replace(path, path + '.migrated')
+
+    print(f'Imported {len(data)} links from {path}')
+    return len(data)
+
+
+def add(link):
+    '''
+    Add a link to the top of the board
+    '''
+    obj = {
+        'idx': uuid.uuid4().hex,
+        'link': link,
+        'date': datetime.now(timezone.utc).isoformat(),
+    }
+    connection().execute(
+        'INSERT INTO links (idx, link, date) VALUES (:idx, :link, :date)',
+        obj,
+    )
+
+    return obj
+
+
+def delete(idx):
+    '''
+    Delete a link by its idx
+
+    Returns:
+        bool: Whether a link was deleted
+    '''
+    cursor = connection().execute('DELETE FROM links WHERE idx = ?', (idx,))
+    return cursor.rowcount > 0
+
+
+def page(offset=0, n=10):
+    '''
+    Get n links, newest first, skipping the first offset
+    '''
+    rows = connection().execute(
+        'SELECT idx, link, date FROM links ORDER BY seq DESC LIMIT ? OFFSET ?',
+        (n, offset),
+    )
+
+    return [dict(row) for row in rows]
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] != 'migrate':
+        sys.exit('Usage: python linkboard.py migrate [path/to/data.json]')
+
+    path = sys.argv[2] if len(sys.argv) > 2 else LEGACY_FILE
+    if not migrate(path):
+        print(f'Nothing imported, {DB_FILE} already has links')
@@ -0,0 +1,189 @@
+'''
+Load test for the game API.
+
+Starts the Flask app against a local Mongo stand-in (mongomock by default, or any
+MONGO_URI such as a local mongod) and a small synthetic embedding file, then plays
+N concurrent games: create -> join -> alternating add_move until the players converge.
+Players wait for each round's score and usually answer with the round's optimal word,
+like real players do.
+
+Reports throughput and p50/p95/p99 latency per endpoint.
+
+Usage:
+    pip install mongomock
+    python loadtest.py [--games 50] [--concurrency 16] [--vocab 20000] [--http]
+'''
+import os
+import sys
+import json
+import time
+import random
+import string
+import argparse
+import tempfile
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+def write_embeddings(path, vocab, dim, seed=0):
+    '''
+    Synthetic GloVe-format file of random lowercase words and vectors
+    '''
+    rng = random.Random(seed)
+    words = set()
+    while len(words) < vocab:
+        words.add(''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(3, 9))))
+
+    vectors = np.random.default_rng(seed).normal(size=(vocab, dim)).astype(np.float32)
+    with open(path, 'w', encoding='utf-8') as f:
+        for word, vec in zip(sorted(words), vectors):
+            f.write(word + ' ' + ' '.join(f'{x:.4f}' for x in vec) + '\n')
+
+
+class Client:
+    '''
+    Calls the app (through the Flask test client, or over HTTP) and records latency per endpoint
+    '''
+    def __init__(self, app, base_url=None):
+        self.app = app
+        self.base_url = base_url
+        self.timings = defaultdict(list)
+        self.lock = threading.Lock()
+        if base_url:
+            import requests
+            self.session = requests.Session()
+        else:
+            self.test_client = app.test_client()
+
+    def call(self, endpoint, method, path, user=None, body=None):
+        headers = {'X-Custom-Data': json.dumps({'user': user})} if user else {}
+        start = time.perf_counter()
+        if self.base_url:
+            response = self.session.request(method, self.base_url + path, headers=headers, json=body)
+            status, data = response.status_code, response.json()
+        else:
+            response = self.test_client.open(path, method=method, headers=headers, json=body)
+            status, data = response.status_code, response.json
+        elapsed = time.perf_counter() - start
+
+        with self.lock:
+            self.timings[endpoint].append(elapsed)
+
+        return status, data
+
+
+def play_game(client, game_no, words, max_rounds, rng):
+    '''
+    One full game between two fresh users
+
+    Returns:
+        int: The number of rounds played
+    '''
+    users = [f'load-{game_no}-a', f'load-{game_no}-b']
+    for user in users:
+        client.call('POST /users', 'POST', '/users', body={
+            'name': user, 'email': f'{user}@example.com', 'provider': 'load',
+            'provider_id': user, 'details': {},
+        })
+
+    _, game_id = client.call('POST /games', 'POST', '/games', user=users[0])
+
+    _, games = client.call('GET /games', 'GET', '/games', user=users[0])
+    phrase = next(game['key_phrase'] for game in games['games'] if game['_id']['$oid'] == game_id)
+    client.call('POST /games/join', 'POST', '/games/join', user=users[1], body={'game_phrase': phrase})
+
+    guesses = [rng.choice(words), rng.choice(words)]
+    for round_idx in range(max_rounds):
+        order = users if round_idx % 2 == 0 else users[::-1]
+        for user in order:
+            guess = guesses[users.index(user)]
+            status, data = client.call('POST /games/<id>/move', 'POST', f'/games/{game_id}/move', user=user, body={'word': guess})
+            if status != 200:
+                raise RuntimeError(f'Move failed for game {game_no}: {status} {data}')
+
+        if data['game_state'] == 'finished':
+            return round_idx + 1
+
+        # Wait for the round's score, like a client watching the game
+        while True:
+            _, game = client.call('GET /games/<id>', 'GET', f'/games/{game_id}', user=users[0])
+            if not game['score_pending'] and len(game['optimal_moves']) > round_idx:
+                break
+            time.sleep(0.01)
+
+        # Mostly converge on the optimal word, sometimes wander
+        optimal = game['optimal_moves'][round_idx] or rng.choice(words)
+        guesses = [optimal if rng.random() < 0.7 else rng.choice(words) for _ in users]
+        if round_idx == max_rounds - 2:
+            guesses = [optimal, optimal]
+
+    return max_rounds
+
+
+def report(timings, elapsed, rounds):
+    total = sum(len(samples) for samples in timings.values())
+    print(f'{len(rounds)} games, {sum(rounds)} rounds, {total} requests in {elapsed:.2f}s')
+    print(f'throughput: {total / elapsed:.1f} req/s, {len(rounds) / elapsed:.2f} games/s')
+    print()
+    print(f'{"endpoint":<24} {"count":>7} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"max ms":>8}')
+    for endpoint, samples in sorted(timings.items()):
+        ms = np.array(samples) * 1000
+        p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+        print(f'{endpoint:<24} {len(ms):>7} {p50:8.2f} {p95:8.2f} {p99:8.2f} {ms.max():8.2f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--games', type=int, default=50, help='Games to play')
+    parser.add_argument('--concurrency', type=int, default=16, help='Games played at once')
+    parser.add_argument('--max-rounds', type=int, default=8, help='Rounds before players are forced to converge')
+    parser.add_argument('--vocab', type=int, default=20000, help='Words in the synthetic embedding file')
+    parser.add_argument('--dim', type=int, default=100, help='Embedding dimensions')
+    parser.add_argument('--mongo', default='mongomock://', help='MONGO_URI to run against')
+    parser.add_argument('--http', action='store_true', help='Serve the app on a local port and call it over HTTP')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='converge-load-')
+    glove_path = os.path.join(workdir, 'glove.synthetic.txt')
+    write_embeddings(glove_path, args.vocab, args.dim, args.seed)
+
+    # Configure the app before importing it
+    os.environ['GLOVE_PATH'] = glove_path
+    os.environ['MONGO_URI'] = args.mongo
+    os.environ.setdefault('SCORING_WORKERS', '4')
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import server
+    import ling
+    import linkboard
+
+    linkboard.DB_FILE = os.path.join(workdir, 'links.db')
+    ling.wait_ready()
+    words = ling.words
+
+    base_url = None
+    if args.http:
+        from werkzeug.serving import make_server
+        http_server = make_server('127.0.0.1', 0, server.app, threaded=True)
+        threading.Thread(target=http_server.serve_forever, daemon=True).start()
+        base_url = f'http://127.0.0.1:{http_server.server_port}'
+
+    client = Client(server.app, base_url)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        futures = [
+            pool.submit(play_game, client, i, words, args.max_rounds, random.Random(args.seed * 100003 + i))
+            for i in range(args.games)
+        ]
+        rounds = [future.result() for future in futures]
+    elapsed = time.perf_counter() - start
+
+    print(f'Vocabulary: {len(words):,} words x {args.dim}d, Mongo: {args.mongo}, via {"HTTP" if base_url else "test client"}')
+    report(client.timings, elapsed, rounds)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+'''
+Lightweight latency instrumentation, exposed in Prometheus text format at /metrics.
+
+Records:
+    - converge_request_seconds: per route/method/status latency
+    - converge_component_seconds: time in Mongo commands (via a pymongo command listener),
+      ling scoring and JSON serialization, as marked with timed()/timed_function()
+
+Each request also collects its own per-component breakdown. Set SLOW_REQUEST_MS to log
+that breakdown for requests slower than the threshold.
+
+Metrics are per process: with several gunicorn workers each one reports its own.
+'''
+import os
+import json
+import time
+import bisect
+import threading
+import functools
+from contextlib import contextmanager
+
+from flask import request
+from pymongo import monitoring
+
+SLOW_REQUEST_MS = float(os.getenv('SLOW_REQUEST_MS', 0))
+
+# Upper bounds (in seconds) of the histogram buckets
+BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, seconds):
+        i = bisect.bisect_left(BUCKETS, seconds)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += seconds
+
+
+# metric name -> (help, {labels tuple: Histogram})
+_histograms = {
+    'converge_request_seconds': ('Request latency by route', {}),
+    'converge_component_seconds': ('Time spent in Mongo, ling and serialization', {}),
+}
+_lock = threading.Lock()
+
+# Functions returning extra (name, type, help, [(labels dict, value)]) samples
+collectors = []
+
+_local = threading.local()
+
+
+def observe(name, labels, seconds):
+    series = _histograms[name][1]
+    key = tuple(sorted(labels.items()))
+    histogram = series.get(key)
+    if histogram is None:
+        with _lock:
+            histogram = series.setdefault(key, Histogram())
+
+    histogram.observe(seconds)
+
+
+def record_component(component, seconds):
+    '''
+    Record time spent in a component, globally and against the current request
+    '''
+    observe('converge_component_seconds', {'component': component}, seconds)
+
+    breakdown = getattr(_local, 'breakdown', None)
+    if breakdown is not None:
+        breakdown[component] = breakdown.get(component, 0.0) + seconds
+
+
+@contextmanager
+def timed(component):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_component(component, time.perf_counter() - start)
+
+
+def timed_function(component):
+    '''
+    Decorator form of timed()
+    '''
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with timed(component):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class MongoListener(monitoring.CommandListener):
+    '''
+    Times every Mongo command. pymongo publishes these on the thread that ran the command,
+    so they're attributed to the request running on that thread.
+    '''
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        record_component(f'mongo.{event.command_name}', event.duration_micros / 1e6)
+
+    def failed(self, event):
+        record_component(f'mongo.{event.command_name}', event.duration_micros / 1e6)
+
+
+# Must be registered before the (lazily created) Mongo client connects
+monitoring.register(MongoListener())
+
+
+def init_app(app):
+    '''
+    Time every request of a Flask app
+    '''
+    @app.before_request
+    def start_request():
+        _local.start = time.perf_counter()
+        _local.breakdown = {}
+
+    @app.after_request
+    def end_request(response):
+        start = getattr(_local, 'start', None)
+        if start is None:
+            return response
+
+        seconds = time.perf_counter() - start
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        observe('converge_request_seconds', {
+            'route': route,
+            'method': request.method,
+            'status': str(response.status_code),
+        }, seconds)
+
+        if SLOW_REQUEST_MS and seconds * 1000 >= SLOW_REQUEST_MS:
+            print('Slow request:', json.dumps({
+                'route': route,
+                'method': request.method,
+                'status': response.status_code,
+                'ms': round(seconds * 1000, 2),
+                'breakdown_ms': {k: round(v * 1000, 2) for k, v in _local.breakdown.items()},
+            }))
+
+        _local.start = None
+        _local.breakdown = None
+        return response
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"') for value in labels.values())
+    return '{' + ','.join(f'{key}="{value}"' for key, value in zip(labels, escaped)) + '}'
+
+
+def render():
+    '''
+    All metrics in the Prometheus text exposition format
+    '''
+    lines = []
+    for name, (help_text, series) in _histograms.items():
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} histogram')
+        with _lock:
+            items = sorted(series.items(), key=lambda item: item[0])
+
+        for key, histogram in items:
+            labels = dict(key)
+            with histogram.lock:
+                counts = list(histogram.counts)
+                total = histogram.sum
+
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ['+Inf'], counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{_format_labels({**labels, "le": bound})} {cumulative}')
+            lines.append(f'{name}_sum{_format_labels(labels)} {total}')
+            lines.append(f'{name}_count{_format_labels(labels)} {cumulative}')
+
+    for collector in collectors:
+        for name, metric_type, help_text, samples in collector():
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            for labels, value in samples:
+                lines.append(f'{name}{_format_labels(labels)} {value}')
+
+    return '\n'.join(lines) + '\n'
@@ -1,5 +1,7 @@
 import os
+import threading
 import pymongo
+from pymongo import IndexModel, ASCENDING, DESCENDING
 import dotenv
 
 dotenv.load_dotenv()
@@ -9,12 +11,107 @@ MONGO_URI = os.getenv('MONGO_URI')
 if not MONGO_URI:
     raise ValueError('Env variable not set: MONGO_URI (add to server/.env)')
 
+def connect(uri):
+    '''
+    MongoClient for a URI. mongomock:// gives an in-memory stand-in (for benchmarks and local runs).
+    '''
+    if uri.startswith('mongomock://'):
+        import mongomock
+        return mongomock.MongoClient()
+
+    return pymongo.MongoClient(uri)
+
+# Indexes for every query shape in games.py/users.py/stats.py/archive.py (check with check_indexes.py)
+INDEXES = {
+    'users': [
+        # users.create_user relies on this for uniqueness
+        IndexModel([('provider_id', ASCENDING)], unique=True, name='provider_id_unique'),
+        # Recent changes for events.py's poll
+        IndexModel([('changed_at', ASCENDING)], name='changed_at'),
+    ],
+    'games': [
+        IndexModel([('key_phrase', ASCENDING)], unique=True, name='key_phrase_unique'),
+        # One per branch of the player1/player2 $or in games.get_games
+        IndexModel([('player1', ASCENDING)], name='player1'),
+        IndexModel([('player2', ASCENDING)], name='player2'),
+        # Finished games for archive.py
+        IndexModel([('game_state', ASCENDING), ('updated_at', ASCENDING)], name='game_state_updated_at'),
+        # Recent changes for events.py's poll
+        IndexModel([('changed_at', ASCENDING)], name='changed_at'),
+    ],
+    'games_archive': [
+        # One per branch of archive.get_summaries, newest first
+        IndexModel([('player1', ASCENDING), ('finished_at', DESCENDING)], name='player1_finished_at'),
+        IndexModel([('player2', ASCENDING), ('finished_at', DESCENDING)], name='player2_finished_at'),
+    ],
+    'user_stats': [
+        IndexModel([('provider_id', ASCENDING)], unique=True, name='provider_id_unique'),
+        # One per leaderboard in stats.BOARDS, provider_id breaks ties
+        IndexModel([('games_finished', DESCENDING), ('provider_id', ASCENDING)], name='games_finished'),
+        IndexModel([('avg_rounds', ASCENDING), ('provider_id', ASCENDING)], name='avg_rounds'),
+        IndexModel([('mean_score', DESCENDING), ('provider_id', ASCENDING)], name='mean_score'),
+        IndexModel([('best_score', DESCENDING), ('provider_id', ASCENDING)], name='best_score'),
+    ],
+}
+
 class DatabaseInterace:
+    '''
+    Lazily connects on first use.
+    pymongo clients are not fork-safe, so each process (e.g. each gunicorn worker) gets its own client.
+    '''
     def __init__(self):
-        self.client = pymongo.MongoClient(MONGO_URI)
-        self.db = self.client['converge']
+        self._client = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        if self._client is None or self._pid != os.getpid():
+            with self._lock:
+                if self._client is None or self._pid != os.getpid():
+                    self._client = connect(MONGO_URI)
+                    self._pid = os.getpid()
+                    self.ensure_indexes()
+
+        return self._client
+
+    @property
+    def db(self):
+        return self.client['converge']
+
+    @property
+    def users(self):
+        return self.db['users']
+
+    @property
+    def games(self):
+        return self.db['games']
+
+    @property
+    def games_archive(self):
+        return self.db['games_archive']
+
+    @property
+    def user_stats(self):
+        return self.db['user_stats']
+
+    def ensure_indexes(self):
+        '''
+        Create the INDEXES (a no-op for ones that already exist)
+        '''
+        for collection, indexes in INDEXES.items():
+            try:
+                self.db[collection].create_indexes(indexes)
+            except pymongo.errors.PyMongoError as e:
+                # e.g. existing duplicates blocking a unique index, keep serving without it
+                print(f'Failed to create indexes on {collection}:', e)
 
-        self.users = self.db['users']
-        self.games = self.db['games']
+    def reset(self):
+        '''
+        Drop the client (without closing it, it may belong to the parent process)
+        so the next access connects again
+        '''
+        self._client = None
+        self._pid = None
 
 db = DatabaseInterace()
@@ -0,0 +1,185 @@
+'''
+Link previews for /preview.
+
+Previews are cached in an LRU with a TTL, failures included (for a shorter time) so a
+broken link isn't fetched again by every viewer of the board. Concurrent requests for
+the same URL share one fetch. Fetches have a connect/read timeout, an overall deadline
+and a cap on how much of the page is read. Set PREVIEW_CACHE_DB to a sqlite file to keep
+the cache across restarts and share it between workers.
+'''
+import os
+import json
+import time
+import sqlite3
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import requests
+import hyperlink_preview as HLP
+
+# Local imports
+import utils
+
+TTL = int(os.getenv('PREVIEW_TTL', 24 * 60 * 60))
+NEGATIVE_TTL = int(os.getenv('PREVIEW_NEGATIVE_TTL', 10 * 60))
+MAX_ENTRIES = 2048
+CONNECT_TIMEOUT = 3
+READ_TIMEOUT = 5
+DEADLINE = 8
+MAX_BYTES = 512 * 1024
+CACHE_DB = os.getenv('PREVIEW_CACHE_DB')
+
+cache = utils.LRUCache(MAX_ENTRIES, TTL)
+executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='previews')
+
+# url -> Future for fetches in progress
+_in_flight = {}
+_lock = threading.Lock()
+_local = threading.local()
+
+
+class PreviewError(Exception):
+    pass
+
+
+class _Preview(HLP.HyperLinkPreview):
+    '''
+    HyperLinkPreview with a bounded fetch (the library's has no timeout or size limit)
+    '''
+    def _fetch(self, url):
+        return fetch_html(url)
+
+
+def fetch_html(url):
+    '''
+    Get up to MAX_BYTES of a page, within the timeouts
+    '''
+    if urlparse(url).scheme not in ('http', 'https'):
+        raise PreviewError('Only http(s) links can be previewed')
+
+    start = time.monotonic()
+    with requests.get(url, stream=True, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT)) as response:
+        response.raise_for_status()
+
+        chunks = []
+        size = 0
+        for chunk in response.iter_content(chunk_size=16 * 1024):
+            chunks.append(chunk)
+            size += len(chunk)
+            if size >= MAX_BYTES:
+                break
+            if time.monotonic() - start > DEADLINE:
+                raise PreviewError('Timed out fetching preview')
+
+        encoding = response.encoding or 'utf-8'
+
+    return b''.join(chunks)[:MAX_BYTES].decode(encoding, errors='replace')
+
+
+def get(url):
+    '''
+    Get the preview data for a url, from the cache if possible.
+
+    Raises:
+        PreviewError: If the page couldn't be fetched (now or within NEGATIVE_TTL)
+    '''
+    entry = cache.get(url)
+    if entry is None:
+        entry = _load(url)
+
+    if entry is None:
+        with _lock:
+            future = _in_flight.get(url)
+            leader = future is None
+            if leader:
+                future = _in_flight[url] = Future()
+
+        if leader:
+            try:
+                entry = _fetch_entry(url)
+                future.set_result(entry)
+            except Exception as e:
+                future.set_exception(e)
+                raise
+            finally:
+                with _lock:
+                    _in_flight.pop(url, None)
+        else:
+            entry = future.result()
+
+    if entry['error']:
+        raise PreviewError(entry['error'])
+
+    return entry['data']
+
+
+def prefetch(url):
+    '''
+    Warm the cache for a url in the background
+    '''
+    def run():
+        try:
+            get(url)
+        except PreviewError:
+            pass
+
+    executor.submit(run)
+
+
+def _fetch_entry(url):
+    try:
+        entry = {'data': _Preview(url=url).get_data(), 'error': None}
+        ttl = TTL
+    except Exception as e:
+        print(f'Error fetching preview for {url}:', e)
+        entry = {'data': None, 'error': str(e) or type(e).__name__}
+        ttl = NEGATIVE_TTL
+
+    cache.put(url, entry, ttl)
+    _save(url, entry, ttl)
+    return entry
+
+
+def _connection():
+    conn = getattr(_local, 'conn', None)
+    if conn is None or _local.pid != os.getpid():
+        conn = sqlite3.connect(CACHE_DB, timeout=10, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS previews (
+                url TEXT PRIMARY KEY,
+                entry TEXT NOT NULL,
+                expires REAL NOT NULL
+            )
+        ''')
+        _local.conn = conn
+        _local.pid = os.getpid()
+
+    return conn
+
+
+def _load(url):
+    '''
+    Read a still-valid entry from the persistent cache into memory
+    '''
+    if not CACHE_DB:
+        return None
+
+    row = _connection().execute('SELECT entry, expires FROM previews WHERE url = ?', (url,)).fetchone()
+    if not row or row[1] < time.time():
+        return None
+
+    entry = json.loads(row[0])
+    cache.put(url, entry, row[1] - time.time())
+    return entry
+
+
+def _save(url, entry, ttl):
+    if not CACHE_DB:
+        return
+
+    _connection().execute(
+        'INSERT OR REPLACE INTO previews (url, entry, expires) VALUES (?, ?, ?)',
+        (url, json.dumps(entry), time.time() + ttl),
+    )
@@ -0,0 +1,94 @@
+'''
+Compare float32, float16 and int8 embedding storage.
+Each mode is loaded in a fresh process so resident memory is measured in isolation.
+Reports RSS and the score/optimal-word drift against float32 for the poc_test.py word pairs.
+
+Usage:
+    python report_quantization.py
+
+Run from the server directory (next to the GloVe file).
+'''
+import os
+import sys
+import json
+import subprocess
+
+# Word pairs from poc_test.py
+E = ['nut', 'spoiled', 'sick', 'flu', 'cold', 'syrup', 'pharmacy', 'thermometer', 'doctor', 'measure']
+K = ['suspicion', 'nugget', 'chicken', 'soup', 'medicine', 'pill', 'suppository', 'remedy', 'temperature', 'physician']
+
+
+def memory_kb():
+    '''
+    Resident memory of this process split into anonymous and file-backed (mmap) pages
+    '''
+    fields = {}
+    with open('/proc/self/status') as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            if key in ('VmRSS', 'RssAnon', 'RssFile'):
+                fields[key] = int(value.split()[0])
+
+    return fields
+
+
+def measure():
+    '''
+    Child process: load ling with the LING_STORAGE from the env, score the pairs, report memory
+    '''
+    import ling
+    ling.load()
+
+    results = []
+    for a, b in zip(E, K):
+        if ling.validate_word(a) and ling.validate_word(b):
+            results.append(ling.score_words(a, b))
+        else:
+            results.append(None)
+
+    # Touch every row once, as a full optimal_word scan would
+    ling.similarities(ling.take(0))
+
+    print(json.dumps({'memory': memory_kb(), 'results': results}))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--child':
+        measure()
+        sys.exit()
+
+    reports = {}
+    for storage in ['float32', 'float16', 'int8']:
+        output = subprocess.run(
+            [sys.executable, __file__, '--child'],
+            env={**os.environ, 'LING_STORAGE': storage},
+            capture_output=True, text=True, check=True,
+        ).stdout
+        reports[storage] = json.loads(output.strip().splitlines()[-1])
+
+    print(f'{"storage":<8} {"RSS MB":>8} {"anon MB":>8} {"mmap MB":>8} {"max |dscore|":>13} {"optimal match":>14}')
+    baseline = reports['float32']['results']
+    for storage, report in reports.items():
+        memory = report['memory']
+        drifts = []
+        matches = []
+        for base, result in zip(baseline, report['results']):
+            if base is None:
+                continue
+            drifts.append(abs(base['score'] - result['score']))
+            matches.append(base['optimal'] == result['optimal'])
+
+        print(
+            f'{storage:<8} {memory["VmRSS"] / 1024:8.1f} {memory["RssAnon"] / 1024:8.1f} {memory["RssFile"] / 1024:8.1f}'
+            f' {max(drifts, default=0):13.2e} {sum(matches):>7}/{len(matches):<6}'
+        )
+
+    print()
+    print('Per pair (float32 / float16 / int8):')
+    for i, (a, b) in enumerate(zip(E, K)):
+        if baseline[i] is None:
+            print(f'  {a}, {b}: not in vocabulary')
+            continue
+        scores = ' / '.join(f'{reports[s]["results"][i]["score"]:.4f}' for s in reports)
+        optimal = ' / '.join(str(reports[s]['results'][i]['optimal']) for s in reports)
+        print(f'  {a}, {b}: {scores}  optimal: {optimal}')
@@ -0,0 +1,200 @@
+'''
+Re-score stored rounds with the current embeddings and vocabulary.
+
+Each scored round is tagged with the ling.model_id that scored it (`score_models`).
+This job walks the games collection in _id order, re-scores every game that has a round
+from another model (or untagged, from before tagging) with ling.score_pairs, and writes
+the new scores, optimal moves, hints and tags back with one bulk_write per batch.
+
+- Each update only applies if the game's version hasn't changed since it was read, so
+  live moves and scoring are never overwritten. Skipped games are picked up by a rerun.
+- --rate caps how many games are processed per second, to keep the load on production low.
+- Progress is checkpointed after each batch, and a rerun resumes from the checkpoint if
+  the model is the same. Use --restart to scan from the beginning.
+- Rounds with a word that isn't in the current vocabulary keep their old score.
+
+Usage:
+    python rescore.py [--batch-size 200] [--rate 200] [--checkpoint rescore.checkpoint.json]
+
+Run from the server directory (next to the GloVe file) with the same env as the server.
+'''
+import os
+import json
+import time
+import argparse
+
+import bson
+from pymongo import UpdateOne
+
+# Local imports
+from mongoInterface import db
+import utils
+import ling
+import scoring
+
+FIELDS = ['player1_moves', 'player2_moves', 'scores', 'optimal_moves', 'hints', 'score_models', 'version']
+
+
+def needs_rescore(game, force=False):
+    models = game.get('score_models') or []
+    return force or len(models) < len(game['scores']) or any(model != ling.model_id for model in models)
+
+
+def rescore_batch(games):
+    '''
+    Re-score every scored round of the games in one score_pairs call
+
+    Returns:
+        list: UpdateOne ops for the games with something to write
+        int: The number of rounds re-scored
+        int: The number of rounds left as they were (words not in the vocabulary)
+    '''
+    pairs = []
+    for game_no, game in enumerate(games):
+        for round_idx in range(len(game['scores'])):
+            words = (game['player1_moves'][round_idx], game['player2_moves'][round_idx])
+            if all(ling.validate_word(word) for word in words):
+                pairs.append((game_no, round_idx, words))
+
+    results = {}
+    if pairs:
+        played = [
+            [
+                ling.word_index[word]
+                for word in games[g]['player1_moves'][:r + 1] + games[g]['player2_moves'][:r + 1]
+                if word in ling.word_index
+            ]
+            for g, r, _ in pairs
+        ]
+        scores, top = ling.score_pairs(
+            [ling.word_index[a] for _, _, (a, _) in pairs],
+            [ling.word_index[b] for _, _, (_, b) in pairs],
+            exclude=played,
+            k=scoring.HINT_COUNT,
+        )
+        for (g, r, (a, b)), score, rows in zip(pairs, scores, top):
+            candidates = [ling.words[row] for row in rows if row >= 0]
+            results[g, r] = {
+                'score': float(score),
+                'optimal': candidates[0] if candidates else None,
+                'hints': [] if a == b else candidates,
+            }
+
+    ops = []
+    unscorable = 0
+    for game_no, game in enumerate(games):
+        n_rounds = len(game['scores'])
+        old_models = game.get('score_models') or []
+        old_hints = game.get('hints') or []
+
+        update = {'scores': [], 'optimal_moves': [], 'hints': [], 'score_models': []}
+        for round_idx in range(n_rounds):
+            result = results.get((game_no, round_idx))
+            if result is None:
+                unscorable += 1
+                update['scores'].append(game['scores'][round_idx])
+                update['optimal_moves'].append(game['optimal_moves'][round_idx])
+                update['hints'].append(old_hints[round_idx] if len(old_hints) == n_rounds else [])
+                update['score_models'].append(old_models[round_idx] if round_idx < len(old_models) else None)
+                continue
+
+            update['scores'].append(result['score'])
+            update['optimal_moves'].append(result['optimal'])
+            update['hints'].append(result['hints'])
+            update['score_models'].append(ling.model_id)
+
+        if all(game.get(field) == value for field, value in update.items()):
+            continue
+
+        ops.append(UpdateOne(
+            {'_id': game['_id'], 'version': game.get('version')},
+            {'$set': {**update, 'changed_at': utils.utcnow()}, '$inc': {'version': 1}},
+        ))
+
+    return ops, len(results), unscorable
+
+
+def load_checkpoint(path):
+    try:
+        with open(path) as f:
+            checkpoint = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    return checkpoint if checkpoint.get('model') == ling.model_id else None
+
+
+def save_checkpoint(path, checkpoint):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp, path)
+
+
+def run(batch_size, rate, checkpoint_path, restart=False, force=False):
+    checkpoint = None if restart else load_checkpoint(checkpoint_path)
+    if checkpoint:
+        print(f'Resuming after {checkpoint["last_id"]} ({checkpoint["scanned"]:,} games scanned)')
+    else:
+        checkpoint = {
+            'model': ling.model_id,
+            'last_id': None,
+            'scanned': 0,
+            'updated': 0,
+            'skipped': 0,
+            'rounds': 0,
+            'unscorable': 0,
+            'done': False,
+        }
+
+    while True:
+        start = time.monotonic()
+        query = {'scores.0': {'$exists': True}}
+        if checkpoint['last_id']:
+            query['_id'] = {'$gt': bson.ObjectId(checkpoint['last_id'])}
+
+        games = list(db.games.find(query, FIELDS).sort('_id', 1).limit(batch_size))
+        if not games:
+            break
+
+        stale = [game for game in games if needs_rescore(game, force)]
+        ops, rounds, unscorable = rescore_batch(stale) if stale else ([], 0, 0)
+        if ops:
+            result = db.games.bulk_write(ops, ordered=False)
+            checkpoint['updated'] += result.modified_count
+            checkpoint['skipped'] += len(ops) - result.matched_count
+
+        checkpoint['last_id'] = str(games[-1]['_id'])
+        checkpoint['scanned'] += len(games)
+        checkpoint['rounds'] += rounds
+        checkpoint['unscorable'] += unscorable
+        save_checkpoint(checkpoint_path, checkpoint)
+        print(
+            f'{checkpoint["scanned"]:,} games scanned, {checkpoint["updated"]:,} updated, '
+            f'{checkpoint["skipped"]:,} skipped (changed while re-scoring), {checkpoint["rounds"]:,} rounds'
+        )
+
+        # Throttle to `rate` games per second
+        time.sleep(max(0, len(games) / rate - (time.monotonic() - start)))
+
+    checkpoint['done'] = True
+    save_checkpoint(checkpoint_path, checkpoint)
+    print(f'Done re-scoring with {ling.model_id}: {checkpoint["updated"]:,} games updated')
+    if checkpoint['skipped']:
+        print(f'{checkpoint["skipped"]:,} games changed while being re-scored, rerun with --restart to pick them up')
+    if checkpoint['unscorable']:
+        print(f'{checkpoint["unscorable"]:,} rounds have words outside the current vocabulary and kept their scores')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--batch-size', type=int, default=200, help='Games per batch (default: %(default)s)')
+    parser.add_argument('--rate', type=float, default=200, help='Max games per second (default: %(default)s)')
+    parser.add_argument('--checkpoint', default='rescore.checkpoint.json', help='Progress file (default: %(default)s)')
+    parser.add_argument('--restart', action='store_true', help='Ignore the checkpoint and scan from the start')
+    parser.add_argument('--force', action='store_true', help='Re-score rounds already tagged with the current model')
+    args = parser.parse_args()
+
+    ling.load()
+    print(f'Re-scoring with {ling.model_id}')
+    run(args.batch_size, args.rate, args.checkpoint, args.restart, args.force)
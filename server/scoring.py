@@ -0,0 +1,159 @@
+'''
+Background round scoring.
+
+add_move sets `score_pending` on the game when a round completes and hands the
+game to a small thread pool, so the request that completes a round doesn't wait on
+ling.score_words. Rounds are pushed in order and each push is conditional on
+`scores` having exactly `round_idx` entries, so a retried or duplicated job can't
+score a round twice.
+
+A round's optimal word is never one already played in the game. The next best
+candidates are stored alongside it in `hints` for hint features, and the
+ling.model_id that scored it in `score_models` (see rescore.py).
+'''
+import os
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import bson
+from pymongo import ReturnDocument
+
+# Local imports
+from mongoInterface import db
+import utils
+import ling
+import events
+import cache
+import stats
+
+executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv('SCORING_WORKERS', 2)),
+    thread_name_prefix='scoring',
+)
+
+# Candidates stored per round in `hints`
+HINT_COUNT = int(os.getenv('SCORING_HINTS', 10))
+
+# Games with a scoring job queued or running in this process
+_in_flight = set()
+# Games submitted again while their job was running, which it reruns for
+_rerun = set()
+_lock = threading.Lock()
+
+
+def submit(game_id):
+    '''
+    Queue scoring for any completed rounds of a game that don't have a score yet.
+    If this process already has a job for the game, it runs again once it finishes
+    (it may have read the moves before the new round completed).
+    '''
+    game_id = str(game_id)
+    with _lock:
+        if game_id in _in_flight:
+            _rerun.add(game_id)
+            return
+        _in_flight.add(game_id)
+
+    executor.submit(_run, game_id)
+
+
+def _run(game_id):
+    while True:
+        try:
+            score_game(game_id)
+        except Exception:
+            print(f'Error scoring game {game_id}:')
+            print(traceback.format_exc())
+
+        with _lock:
+            if game_id not in _rerun:
+                _in_flight.discard(game_id)
+                return
+            _rerun.discard(game_id)
+
+
+def _on_os_thread(func, *args, **kwargs):
+    '''
+    Run CPU-bound work on a real thread. Under gevent workers (see gunicorn.conf.py) the executor's
+    threads are greenlets on the worker's one OS thread, so a full vocabulary scan would block every
+    other request. gevent's native threadpool runs it beside them (numpy releases the GIL).
+    '''
+    try:
+        from gevent import monkey, get_hub
+    except ImportError:
+        return func(*args, **kwargs)
+
+    if not monkey.is_module_patched('threading'):
+        return func(*args, **kwargs)
+
+    return get_hub().threadpool.apply(func, args, kwargs)
+
+
+def score_game(game_id):
+    '''
+    Score every completed round of a game that is missing a score
+    '''
+    ling.wait_ready()
+
+    _id = bson.ObjectId(game_id)
+    game = db.games.find_one({'_id': _id}, {'player1_moves': 1, 'player2_moves': 1, 'scores': 1})
+    if not game:
+        return
+
+    rounds = min(len(game['player1_moves']), len(game['player2_moves']))
+    for round_idx in range(len(game['scores']), rounds):
+        played = game['player1_moves'][:round_idx + 1] + game['player2_moves'][:round_idx + 1]
+        if not score_round(_id, round_idx, game['player1_moves'][round_idx], game['player2_moves'][round_idx], played):
+            # Another job already scored this round
+            return
+
+    # Clear the flag, unless another round completed in the meantime
+    # (one player having exactly `rounds` moves means no new round is complete)
+    game = db.games.find_one_and_update(
+        {
+            '_id': _id,
+            'scores': {'$size': rounds},
+            '$or': [
+                {'player1_moves': {'$size': rounds}},
+                {'player2_moves': {'$size': rounds}},
+            ],
+        },
+        {'$set': {'score_pending': False, 'changed_at': utils.utcnow()}, '$inc': {'version': 1}},
+        return_document=ReturnDocument.AFTER,
+    )
+    if game:
+        cache.put_game(game)
+        events.publish(game, 'score')
+
+
+def score_round(_id, round_idx, word1, word2, played=()):
+    '''
+    Push the score, optimal word and hints for one round, skipping the played words.
+    Only applies if the round is the next one to score.
+
+    Returns:
+        bool: Whether this call pushed the score
+    '''
+    ling_result = _on_os_thread(ling.score_words, word1, word2, exclude=played, k=HINT_COUNT)
+    game = db.games.find_one_and_update(
+        {'_id': _id, 'scores': {'$size': round_idx}},
+        {
+            '$push': {
+                'scores': ling_result['score'],
+                'optimal_moves': ling_result['optimal'],
+                'hints': [word for word, _ in ling_result['candidates']],
+                'score_models': ling.model_id,
+            },
+            '$set': {'changed_at': utils.utcnow()},
+            '$inc': {'version': 1},
+        },
+        return_document=ReturnDocument.AFTER,
+    )
+    if not game:
+        return False
+
+    cache.put_game(game)
+    events.publish(game, 'score')
+    stats.record_round(game, round_idx)
+    return True
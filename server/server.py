@@ -1,17 +1,21 @@
-import uuid
 import json
 import os
-from datetime import datetime
-from datetime import timezone
 import traceback
 # Library imports
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Response, request, jsonify, send_from_directory, stream_with_context
 from flask_cors import CORS
 from dotenv import load_dotenv
 
 # Local imports
 import users
 import games
+import events
+import utils
+import linkboard
+import previews
+import ling
+import metrics
+import stats
 
 # Start server
 load_dotenv()
@@ -21,71 +25,34 @@ app = Flask(__name__,
     static_url_path='')
 CORS(app)
 
+# Encode mongo docs (ObjectId, datetime) directly in jsonify
+app.json = utils.BSONJSONProvider(app)
 
-FILE = 'data.json'
+# Per-route latency histograms, served at /metrics
+metrics.init_app(app)
 
-def checkfile():
-    datafile = os.path.join(os.path.dirname(__file__), FILE)
-    if not os.path.exists(datafile):
-        with open(datafile, 'w') as file:
-            json.dump([], file)
+# Load the word model in the background so routes that don't need it serve right away
+ling.start_loading()
 
-    with open(datafile) as file:
-        content = file.read()
+# Pick up other processes' writes (for the cache and event streams) in whichever process serves,
+# since the watcher thread is per process and gunicorn forks after import
+app.before_request(events.start)
 
-    if not content:
-        with open(datafile, 'w') as file:
-            json.dump([], file)
 
-    return datafile
+# Seconds between keep-alive comments on idle event streams
+HEARTBEAT = 15
 
+# Default and maximum number of archived game summaries per page of GET /games
+ARCHIVE_LIMIT = 10
+ARCHIVE_MAX_LIMIT = 50
 
-def addToFile(link):
-    # Create emtpy file if os.path does not exist
-    datafile = checkfile()
-
-    # Prepend to json file
-    datestr = datetime.now(timezone.utc).isoformat()
-
-    obj = {
-        'idx': uuid.uuid4().hex,
-        'link': link,
-        'date': datestr,
-    }
-
-    try:
-        data = readfile()
-        data.insert(0, obj)
-
-        with open(datafile, 'w') as file:
-            json.dump(data, file)
-
-        return True
-    except Exception as e:
-        print(f'failed to add to file with e', e)
-        return False
-
-def readfile():
-    datafile = checkfile()
-    with open(datafile) as file:
-        content = json.load(file)
-
-    return content
-
-def deleteFromFile(idx):
-    datafile = checkfile()
-    try:
-        data = readfile()
-        data = [item for item in data if item['idx'] != idx]
-
-        with open(datafile, 'w') as file:
-            json.dump(data, file)
-
-        return True
-    except Exception as e:
-        print(f'failed to delete from file with e', e)
-        return False
+# Default and maximum number of leaderboard entries per page
+LEADERBOARD_LIMIT = 10
+LEADERBOARD_MAX_LIMIT = 100
 
+# Default and maximum number of suggestions from /words/complete
+COMPLETE_LIMIT = 10
+COMPLETE_MAX_LIMIT = 50
 
 # Serve React App
 @app.route('/')
@@ -93,6 +60,29 @@ def serve():
     print(f'Serving static files from {app.static_folder}')
     return send_from_directory(app.static_folder, 'index.html')
 
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    '''
+    Liveness: the process is up and serving
+    '''
+    return jsonify({'status': 'ok'}), 200
+
+@app.route('/readyz', methods=['GET'])
+def readyz():
+    '''
+    Readiness: the word model is loaded and moves can be played.
+    Reports the loading state and progress either way.
+    '''
+    status = ling.status()
+    return jsonify(status), 200 if status['state'] == 'ready' else 503
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    '''
+    Latency histograms in Prometheus text format
+    '''
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/links', methods=['GET'])
 def get_signin_url():
     '''
@@ -102,9 +92,8 @@ def get_signin_url():
     offset = int(request.args.get('offset') or 0)
     n = int(request.args.get('n') or 10)
 
-    # Read from the file
-    data = readfile()
-    payload = data[offset:offset+n]
+    # Read just the requested page
+    payload = linkboard.page(offset, n)
 
     # Return payload
     return jsonify(payload), 200
@@ -114,7 +103,6 @@ def get_signin_url():
 def login():
     '''
     POST a link to the board.
-    Will add to a file.
     '''
     # Get request args
     link = request.json.get('link')
@@ -122,15 +110,10 @@ def login():
     if not link:
         return jsonify({'error': 'No link provided'}), 400
 
-    # Try to add to the file
+    # Try to add to the board
     try:
-        success = addToFile(link)
-
-        if not success:
-            return jsonify({
-                'success': False,
-                'message': 'Server failed to post link',
-            }), 500
+        linkboard.add(link)
+        previews.prefetch(link)
 
         return jsonify({
             'success': True,
@@ -153,13 +136,7 @@ def delete_link(idx):
     DELETE a link from the board by its idx.
     '''
     try:
-        success = deleteFromFile(idx)
-
-        if not success:
-            return jsonify({
-                'success': False,
-                'message': 'Server failed to delete link',
-            }), 500
+        linkboard.delete(idx)
 
         return jsonify({
             'success': True,
@@ -180,8 +157,7 @@ def get_preview():
         return jsonify({'error': 'No URL provided'}), 400
 
     try:
-        preview = HLP.HyperLinkPreview(url=url)
-        preview = preview.get_data()
+        preview = previews.get(url)
         return jsonify(preview), 200
     except Exception as e:
         print('Error fetching preview:', e)
@@ -205,17 +181,48 @@ def create_game():
         print('Error creating game:', e)
         return jsonify({'error': str(e)}), 500
 
+def conditional(etag, build):
+    '''
+    Answer If-None-Match with a 304 if the etag matches, otherwise build the full response.
+    Responses must be revalidated, and vary by the user header.
+    '''
+    headers = {
+        'ETag': f'"{etag}"',
+        'Cache-Control': 'no-cache',
+        'Vary': 'X-Custom-Data',
+    }
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers=headers)
+
+    result, code = build()
+    response = jsonify(result)
+    if code == 200:
+        response.headers.update(headers)
+
+    return response, code
+
 @app.route('/games', methods=['GET'])
 def get_games():
     '''
-    Get all games
+    Get all active games, and a page of archived game summaries (?archive_offset=&archive_limit=)
     '''
     try:
         header_data = request.headers.get('X-Custom-Data')
         user_id = json.loads(header_data).get('user')
 
-        result, code = games.get_games(user_id=user_id)
-        return jsonify(result), code
+        try:
+            page = {
+                'archive_offset': max(int(request.args.get('archive_offset', 0)), 0),
+                'archive_limit': min(max(int(request.args.get('archive_limit', ARCHIVE_LIMIT)), 1), ARCHIVE_MAX_LIMIT),
+            }
+        except ValueError:
+            return jsonify({'error': 'archive_offset and archive_limit must be integers'}), 400
+
+        etag, code = games.get_games_etag(user_id=user_id, **page)
+        if code != 200:
+            return jsonify(etag), code
+
+        return conditional(etag, lambda: games.get_games(user_id=user_id, **page))
     except Exception as e:
         print('Error getting games:', e)
         return jsonify({'error': str(e)}), 500
@@ -229,12 +236,95 @@ def get_game(game_id):
         header_data = request.headers.get('X-Custom-Data')
         user_id = json.loads(header_data).get('user')
 
-        result, code = games.get_game(game_id=game_id, user_id=user_id)
-        return jsonify(result), code
+        # Load once for both the ETag and the body
+        loaded, code = games.load_game(game_id=game_id, user_id=user_id)
+        if code != 200:
+            return jsonify(loaded), code
+
+        etag = games.game_etag(*loaded, user_id)
+        return conditional(etag, lambda: (games.view_game(*loaded, user_id), 200))
     except Exception as e:
         print('Error getting game:', e)
         return jsonify({'error': str(e)}), 500
 
+@app.route('/games/<game_id>/events', methods=['GET'])
+def game_events(game_id):
+    '''
+    Stream changes to a game as Server-Sent Events.
+    Sends a snapshot of the game first (or when the client is too far behind),
+    then move/score/state events with the changed fields.
+    Event ids are the game's version, and a reconnect resumes from the Last-Event-ID
+    header (or ?since=) when every change since then is still buffered.
+    '''
+    try:
+        # EventSource can't set headers, so also accept the user as a query arg
+        header_data = request.headers.get('X-Custom-Data')
+        user_id = json.loads(header_data).get('user') if header_data else request.args.get('user')
+
+        since = request.headers.get('Last-Event-ID') or request.args.get('since')
+        try:
+            since = int(since) if since else None
+        except ValueError:
+            return jsonify({'error': 'Last-Event-ID (or since) must be an integer'}), 400
+
+        # Subscribe before reading the game so no change is missed in between
+        channel = events.channel(game_id)
+        loaded, code = games.load_game(game_id=game_id, user_id=user_id)
+        if code != 200:
+            return jsonify(loaded), code
+
+        # Events are sent from the subscriber's point of view, like the snapshot
+        player1 = loaded[0]['player1']
+        snapshot = games.view_game(*loaded, user_id)
+    except Exception as e:
+        print('Error streaming game events:', e)
+        return jsonify({'error': str(e)}), 500
+
+    def format_event(event_id, event, data):
+        return f'id: {event_id}\nevent: {event}\ndata: {app.json.dumps(data)}\n\n'
+
+    def resume():
+        # Buffered events since the client's version, if they reach the snapshot's
+        if since is None or since > snapshot.get('version', 0):
+            return None
+        pending = channel.since(since)
+        if pending is None or (pending[-1][0] if pending else since) < snapshot.get('version', 0):
+            return None
+        return pending
+
+    def stream():
+        nonlocal channel, snapshot
+
+        version = since
+        pending = resume()
+        while True:
+            # Too far behind, or the channel was dropped: start over from a snapshot
+            if pending is None:
+                if snapshot is None:
+                    snapshot, code = games.get_game(game_id=game_id, user_id=user_id)
+                    if code != 200:
+                        return
+                version = snapshot.get('version', 0)
+                yield format_event(version, 'snapshot', snapshot)
+                snapshot = None
+            elif not pending:
+                yield ': heartbeat\n\n'
+
+            for event_id, event, data in pending or []:
+                yield format_event(event_id, event, games.view_event(data, user_id, player1))
+                version = event_id
+
+            pending = channel.wait(version, HEARTBEAT)
+            current = events.channel(game_id)
+            if current is not channel:
+                channel = current
+                pending = None
+
+    return Response(stream_with_context(stream()), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+
 @app.route('/games/join', methods=['POST'])
 def join_game():
     '''
@@ -267,6 +357,32 @@ def add_move(game_id):
         print('Error adding move:', e)
         return jsonify({'error': str(e)}), 500
 
+@app.route('/words/complete', methods=['GET'])
+def complete_word():
+    '''
+    Valid words starting with a prefix, playable words first and then most common first,
+    and whether the prefix itself is a valid move
+    '''
+    prefix = request.args.get('prefix', '').strip().lower()
+    if not prefix:
+        return jsonify({'error': 'No prefix provided'}), 400
+
+    try:
+        limit = min(max(int(request.args.get('limit', COMPLETE_LIMIT)), 1), COMPLETE_MAX_LIMIT)
+    except ValueError:
+        return jsonify({'error': 'limit must be an integer'}), 400
+
+    if ling.status()['state'] == 'failed':
+        return jsonify({'error': 'Word model failed to load'}), 500
+    if not ling.wait_ready(0):
+        return jsonify({'error': 'Word model is still loading, try again shortly'}), 503
+
+    return jsonify({
+        'prefix': prefix,
+        'valid': ling.validate_word(prefix),
+        'words': ling.complete(prefix, limit),
+    }), 200
+
 @app.route('/users', methods=['POST'])
 def create_user():
     '''
@@ -298,6 +414,39 @@ def get_user(user_id):
             'stack': traceback.format_exc()
         }), 500
 
+@app.route('/users/<user_id>/stats', methods=['GET'])
+def get_user_stats(user_id):
+    '''
+    Get a user's game statistics.
+    '''
+    try:
+        response, code = stats.get_stats(user_id)
+        return jsonify(response), code
+    except Exception as e:
+        print('Error getting user stats:', e)
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/leaderboard', methods=['GET'])
+def get_leaderboard():
+    '''
+    Top players by ?by= (games_finished, avg_rounds, mean_score or best_score), paged with ?offset=&limit=
+    '''
+    try:
+        header_data = request.headers.get('X-Custom-Data')
+        user_id = json.loads(header_data).get('user') if header_data else None
+
+        by = request.args.get('by', 'games_finished')
+        limit = min(max(int(request.args.get('limit', LEADERBOARD_LIMIT)), 1), LEADERBOARD_MAX_LIMIT)
+        offset = max(int(request.args.get('offset', 0)), 0)
+
+        response, code = stats.leaderboard(by, limit, offset, user_id)
+        return jsonify(response), code
+    except ValueError:
+        return jsonify({'error': 'limit and offset must be integers'}), 400
+    except Exception as e:
+        print('Error getting leaderboard:', e)
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/users/<user_id>', methods=['PATCH'])
 def update_user(user_id):
     '''
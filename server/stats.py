@@ -0,0 +1,220 @@
+'''
+Per-user statistics, kept up to date as games are played, and the leaderboards built on them.
+
+One user_stats doc per player, updated in place with upsert pipelines:
+    - games_played: games joined by an opponent
+    - games_finished, rounds_total, avg_rounds: finished games and the rounds they took to converge
+    - rounds_scored, score_total, mean_score, best_score: similarity of the player's scored rounds,
+      leaving out the converging round (where both played the same word and the score is 1)
+
+Joins and finishes are recorded by games.py, scored rounds by scoring.py. Rescoring
+(rescore.py) doesn't update the stats, rebuild them afterwards with:
+
+    python stats.py backfill
+'''
+import sys
+import itertools
+import traceback
+from datetime import datetime
+
+from pymongo import ASCENDING, DESCENDING
+
+# Local imports
+from mongoInterface import db, INDEXES
+import cache
+import archive
+
+# Least finished games/scored rounds to rank on an average
+MIN_GAMES = 3
+MIN_ROUNDS = 10
+
+# Leaderboard name -> (sort field, direction, filter)
+BOARDS = {
+    'games_finished': ('games_finished', DESCENDING, {'games_finished': {'$gt': 0}}),
+    'avg_rounds': ('avg_rounds', ASCENDING, {'avg_rounds': {'$ne': None}, 'games_finished': {'$gte': MIN_GAMES}}),
+    'mean_score': ('mean_score', DESCENDING, {'mean_score': {'$ne': None}, 'rounds_scored': {'$gte': MIN_ROUNDS}}),
+    'best_score': ('best_score', DESCENDING, {'best_score': {'$ne': None}}),
+}
+
+# Stats of a player with no games yet (averages and best are None until there's data)
+EMPTY = {
+    'games_played': 0,
+    'games_finished': 0,
+    'rounds_total': 0,
+    'avg_rounds': None,
+    'rounds_scored': 0,
+    'score_total': 0,
+    'mean_score': None,
+    'best_score': None,
+}
+
+
+def record_join(game):
+    '''
+    Count a game as played for both players
+    '''
+    for player in (game['player1'], game['player2']):
+        _update(player, {'games_played': 1})
+
+
+def record_finish(game):
+    '''
+    Count a finished game and the rounds it took, for both players
+    '''
+    rounds = len(game['player1_moves'])
+    for player in (game['player1'], game['player2']):
+        _update(player, {'games_finished': 1, 'rounds_total': rounds})
+
+
+def record_round(game, round_idx):
+    '''
+    Add a scored round to both players' similarity stats
+    '''
+    if game['player1_moves'][round_idx] == game['player2_moves'][round_idx]:
+        return
+
+    score = game['scores'][round_idx]
+    for player in (game['player1'], game['player2']):
+        _update(player, {'rounds_scored': 1, 'score_total': score}, {'best_score': score})
+
+
+def _update(provider_id, increments, maxes=None):
+    '''
+    Apply increments and maxes to a user's stats and recompute the averages, in one upsert.
+    Errors are logged rather than raised, the game write they follow has already happened.
+    '''
+    if not provider_id:
+        return
+
+    changes = {field: {'$add': [{'$ifNull': [f'${field}', 0]}, value]} for field, value in increments.items()}
+    changes.update({field: {'$max': [f'${field}', value]} for field, value in (maxes or {}).items()})
+    changes['updated_at'] = datetime.now()
+
+    try:
+        db.user_stats.update_one(
+            {'provider_id': provider_id},
+            [{'$set': changes}, {'$set': _averages()}],
+            upsert=True,
+        )
+    except Exception:
+        print(f'Error updating stats for {provider_id}:')
+        print(traceback.format_exc())
+
+
+def _averages():
+    def average(total, count):
+        count = {'$ifNull': [f'${count}', 0]}
+        return {'$cond': [{'$gt': [count, 0]}, {'$divide': [f'${total}', count]}, None]}
+
+    return {
+        'avg_rounds': average('rounds_total', 'games_finished'),
+        'mean_score': average('score_total', 'rounds_scored'),
+    }
+
+
+def get_stats(user_id):
+    '''
+    A user's stats (all zero before their first game)
+    '''
+    user = cache.get_user(user_id)
+    if not user:
+        return {'error': 'User not found'}, 404
+
+    stats = db.user_stats.find_one({'provider_id': user_id}, {'_id': 0, 'provider_id': 0}) or {}
+    return {field: stats.get(field, default) for field, default in EMPTY.items()}, 200
+
+
+def leaderboard(by, limit=10, offset=0, user_id=None):
+    '''
+    Top players by one of the BOARDS, read in order from that field's index.
+    Entries have the player's name and stats (not their provider id), and `you` for the caller.
+    '''
+    if by not in BOARDS:
+        return {'error': f'Unknown leaderboard: {by} (expected one of {list(BOARDS)})'}, 400
+
+    field, direction, query = BOARDS[by]
+    rows = list(
+        db.user_stats.find(query, {'_id': 0, 'updated_at': 0})
+        .sort([(field, direction), ('provider_id', ASCENDING)])
+        .skip(offset)
+        .limit(limit)
+    )
+    users_by_id = cache.get_users({row['provider_id'] for row in rows})
+
+    entries = []
+    for rank, row in enumerate(rows, start=offset + 1):
+        provider_id = row.pop('provider_id')
+        user = users_by_id.get(provider_id)
+        entries.append({
+            'rank': rank,
+            'name': user['name'] if user else None,
+            'you': provider_id == user_id,
+            **row,
+        })
+
+    return {'by': by, 'offset': offset, 'entries': entries}, 200
+
+
+def backfill(batch_size=1000):
+    '''
+    Rebuild user_stats from every game (active and archived), into a new collection swapped in at the end.
+    Stats recorded by live games while this runs are lost, so run it when traffic is low.
+    '''
+    totals = {}
+    def user(provider_id):
+        return totals.setdefault(provider_id, dict(EMPTY))
+
+    projection = ['player1', 'player2', 'player1_moves', 'player2_moves', 'scores', 'game_state']
+    games = itertools.chain(
+        db.games.find({'player2': {'$ne': None}}, projection, batch_size=batch_size),
+        (archive.expand(archived) for archived in db.games_archive.find({}, {'game': 1}, batch_size=batch_size)),
+    )
+    seen = set()
+    for n, game in enumerate(games, start=1):
+        # A game can briefly be in both while it's being archived
+        if game['_id'] in seen:
+            continue
+        seen.add(game['_id'])
+
+        players = [user(game['player1']), user(game['player2'])]
+        for stats in players:
+            stats['games_played'] += 1
+
+        if game['game_state'] == 'finished':
+            for stats in players:
+                stats['games_finished'] += 1
+                stats['rounds_total'] += len(game['player1_moves'])
+
+        for round_idx, score in enumerate(game['scores']):
+            if game['player1_moves'][round_idx] == game['player2_moves'][round_idx]:
+                continue
+            for stats in players:
+                stats['rounds_scored'] += 1
+                stats['score_total'] += score
+                stats['best_score'] = score if stats['best_score'] is None else max(stats['best_score'], score)
+
+        if n % 10000 == 0:
+            print(f'{n:,} games read')
+
+    now = datetime.now()
+    docs = []
+    for provider_id, stats in totals.items():
+        stats['avg_rounds'] = stats['rounds_total'] / stats['games_finished'] if stats['games_finished'] else None
+        stats['mean_score'] = stats['score_total'] / stats['rounds_scored'] if stats['rounds_scored'] else None
+        docs.append({'provider_id': provider_id, **stats, 'updated_at': now})
+
+    staging = db.db['user_stats_backfill']
+    staging.drop()
+    staging.create_indexes(INDEXES['user_stats'])
+    for start in range(0, len(docs), batch_size):
+        staging.insert_many(docs[start:start + batch_size])
+    staging.rename('user_stats', dropTarget=True)
+
+    print(f'Rebuilt stats for {len(docs):,} players')
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] != ['backfill']:
+        sys.exit('Usage: python stats.py backfill')
+
+    backfill()
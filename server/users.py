@@ -1,5 +1,10 @@
+# Library imports
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
 # Local imports
 from mongoInterface import db
+import cache
 import utils
 
 def create_user(user_data):
@@ -26,31 +31,25 @@ def create_user(user_data):
     if missing_fields:
         return {'error': f'User obj missing required fields: {missing_fields}'}, 400
 
-    # Check a similar user doesn't already exist
-    existing_user = db.users.find_one({
-        'provider_id': user_data['provider_id'],
-    })
-    if existing_user:
+    # Create the user (the unique provider_id index rejects an existing user)
+    try:
+        create_result = db.users.insert_one(user_data)
+    except DuplicateKeyError:
         return {'error': 'User already exists'}, 400
 
-    # Create the user
-    create_result = db.users.insert_one(user_data)
     return {'user_id': str(create_result.inserted_id)}, 200
 
 def get_user(user_id):
     '''
     Gets a user doc
     '''
-    user = db.users.find_one({
-        'provider_id': user_id,
-    })
+    user = cache.get_user(user_id)
 
     # Check the user exists
     if not user:
         return {'error': 'User not found'}, 404
 
-    user_safe = utils.safe_bson(user)
-    return user_safe, 200
+    return user, 200
 
 
 def update_user(user_id, changes):
@@ -84,11 +83,15 @@ def update_user(user_id, changes):
         return {'error': 'No updates provided'}, 400
 
     # Update the user
-    db.users.update_one({
+    user = db.users.find_one_and_update({
         'provider_id': user_id,
     }, {
-        '$set': changes,
-    })
+        '$set': {**changes, 'changed_at': utils.utcnow()},
+        '$inc': {'version': 1},
+    }, return_document=ReturnDocument.AFTER)
+    if user:
+        cache.put_user(user)
+
     return {'success': 'User updated'}, 200
 
 
@@ -1,11 +1,98 @@
+import time
+import datetime
+import threading
+import collections
 import bson
-import json
+from bson import json_util
+from flask.json.provider import DefaultJSONProvider
 
-def safe_bson(bson_obj):
+# Local imports
+import metrics
+
+def bson_default(obj):
+    '''
+    JSON form of a single BSON value, matching bson.json_util's relaxed output
+    (e.g. {'$oid': ...} and {'$date': '2024-01-01T00:00:00.000Z'})
+    '''
+    if isinstance(obj, bson.ObjectId):
+        return {'$oid': str(obj)}
+
+    if isinstance(obj, datetime.datetime):
+        if not obj.tzinfo:
+            obj = obj.replace(tzinfo=datetime.timezone.utc)
+        if obj >= json_util.EPOCH_AWARE and obj.utcoffset() == datetime.timedelta(0):
+            millis = obj.microsecond // 1000
+            fracsecs = f'.{millis:03d}' if millis else ''
+            return {'$date': f'{obj.strftime("%Y-%m-%dT%H:%M:%S")}{fracsecs}Z'}
+
+    # Anything rarer goes through json_util itself
+    return json_util.default(obj)
+
+def utcnow():
+    '''
+    The current UTC time as a naive datetime, the way pymongo reads dates back
+    '''
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+class BSONJSONProvider(DefaultJSONProvider):
+    '''
+    Flask JSON provider that encodes BSON types directly, so route handlers
+    can jsonify mongo docs without converting them first
     '''
-    Converts a bson object (with some non-json items) and converts it to a json object
+    default = staticmethod(bson_default)
+
+    def dumps(self, obj, **kwargs):
+        with metrics.timed('serialize'):
+            return super().dumps(obj, **kwargs)
+
+class LRUCache:
+    '''
+    Thread-safe LRU cache with an optional per-entry TTL (in seconds)
     '''
-    json_string = bson.json_util.dumps(bson_obj)
-    json_obj = json.loads(json_string)
+    def __init__(self, max_entries, ttl=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or (entry[0] is not None and entry[0] < time.monotonic()):
+                self.misses += 1
+                return default
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def peek(self, key, default=None):
+        '''
+        Like get, without counting a hit/miss or refreshing the entry's position
+        '''
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or (entry[0] is not None and entry[0] < time.monotonic()):
+                return default
+
+            return entry[1]
+
+    def put(self, key, value, ttl=None):
+        ttl = ttl if ttl is not None else self.ttl
+        expires = time.monotonic() + ttl if ttl is not None else None
+        with self.lock:
+            self.entries[key] = (expires, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def pop(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+
+        return entry[1] if entry else None
 
-    return json_obj
+    def __len__(self):
+        return len(self.entries)
@@ -36,10 +36,10 @@ in pkgs.mkShell {
     if [ ! -d .venv ]; then
       python -m venv .venv
       source .venv/bin/activate
-      pip install requests flask flask-cors beautifulsoup4
+      pip install requests flask flask-cors beautifulsoup4 gunicorn gevent
     else
       source .venv/bin/activate
-      pip install requests flask flask-cors beautifulsoup4
+      pip install requests flask flask-cors beautifulsoup4 gunicorn gevent
     fi
 
     # Set up Node.js environment variables
@@ -59,9 +59,9 @@ in pkgs.mkShell {
     echo "Building frontend..."
     (cd frontend && npm run build && cd ..)
 
-    # Start the Python server
+    # Start the Python server (flask dev server in dev, pre-forked gunicorn workers otherwise)
     echo "Starting Python server..."
-    cd server && python server.py
+    cd server && ${if isDev then "python server.py" else "gunicorn -c gunicorn.conf.py server:app"}
   '';
 
   # Environment variables